@@ -28,6 +28,13 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+        'gevent': ['gevent'],
+        'inotify': ['pyinotify'],
+        'numpy': ['numpy'],
+        'ujson': ['ujson'],
+    },
     entry_points="""
     """,
 )
@@ -9,6 +9,62 @@ MAIN_DATA_XML = os.path.join(
     os.path.dirname(__file__), '..', 'runtime', 'data', 'sample_data.xml'
 )
 
+# parsed presence data saved for quick start of new processes,
+# None disables snapshots
+MAIN_DATA_SNAPSHOT = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'presence.snapshot'
+)
+
+# byte ranges of users' rows in CSV file, read by 'csv_index' storage
+# backend, None keeps them in memory only
+MAIN_DATA_INDEX = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'presence.index'
+)
+
+# presence database built from CSV file with
+# python -m presence_analyzer.storage import
+MAIN_DATA_SQLITE = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'data', 'presence.sqlite'
+)
+
+# file with id of web app process, signalled to reload by cron,
+# None disables it
+PID_FILE = os.path.join(
+    os.path.dirname(__file__), '..', 'runtime', 'presence_analyzer.pid'
+)
+
 DEBUG = True
 DATA_CSV = MAIN_DATA_CSV
 DATA_XML = MAIN_DATA_XML
+DATA_SNAPSHOT = MAIN_DATA_SNAPSHOT
+DATA_SQLITE = MAIN_DATA_SQLITE
+DATA_INDEX = MAIN_DATA_INDEX
+# 'csv' (file parsed into memory of every process), 'csv_index' (rows of
+# a user read from file when queried, using DATA_INDEX) or 'sqlite'
+# (DATA_SQLITE database queried by user and day)
+STORAGE_BACKEND = 'csv'
+# number of processes started by presence_analyzer.server,
+# 0 starts one per CPU
+WORKERS = 0
+# concurrent connections and computing threads of
+# presence_analyzer.async_server (requires gevent package)
+ASYNC_CONNECTIONS = 10000
+ASYNC_THREADS = 4
+# how often (in seconds) data files are checked for changes when
+# pyinotify is not installed
+WATCH_INTERVAL = 1
+# processes parsing big CSV files in parallel, 1 parses in the serving
+# process, 0 starts one per CPU; used only by presence_analyzer.server
+# master, which loads data with no other threads running
+PARSE_PROCESSES = 1
+# named groups of user ids aggregated at /api/v1/group/<name>/<dimension>,
+# e.g. {'backend': [10, 11]}
+GROUPS = {}
+# 'python' or 'numpy' (requires numpy package)
+ANALYTICS_ENGINE = 'python'
+# 'json' or 'ujson' (faster, requires ujson package, compact output)
+JSON_SERIALIZER = 'json'
+# gzip level or Brotli quality of compressed responses and size (in bytes)
+# of the smallest response worth compressing
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 500
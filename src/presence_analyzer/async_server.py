@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous server holding many concurrent connections in one process.
+
+Connections are handled by gevent greenlets, so idle and slow clients
+cost a greenlet each instead of a thread. Nothing a request waits for
+blocks the event loop: data files are loaded before serving starts and
+reloaded by background threads of ``cache`` (the previous data is served
+meanwhile), while responses missing in ``precomputed`` caches are computed
+in gevent thread pool. Standard library is not monkey patched, so those
+threads stay real threads.
+
+Run with:
+
+    python -m presence_analyzer.async_server [host:port]
+"""
+
+import logging
+import os
+import signal
+import sys
+
+from presence_analyzer import utils
+from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.main import app
+from presence_analyzer.server import warm
+
+try:
+    import gevent
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+except ImportError:  # pragma: no cover
+    gevent = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def make_server(host, port):
+    """
+    Returns gevent WSGI server of the app, not started yet.
+
+    Server accepts at most ASYNC_CONNECTIONS concurrent connections and
+    computes responses in up to ASYNC_THREADS threads.
+    """
+    if gevent is None:
+        raise ImportError('async server requires gevent package')
+    threadpool = gevent.get_hub().threadpool
+    threadpool.maxsize = app.config['ASYNC_THREADS']
+    utils.EXECUTOR = threadpool.apply
+    return WSGIServer(
+        (host, port), app, spawn=Pool(app.config['ASYNC_CONNECTIONS']),
+        log=logging.getLogger('werkzeug'), error_log=log)
+
+
+def main(argv):
+    """
+    Serves the app at address given as ``host:port``.
+    """
+    host, _, port = (argv[1] if len(argv) > 1 else '0.0.0.0:5000') \
+        .rpartition(':')
+    server = make_server(host or '0.0.0.0', int(port))
+    warm()
+    if app.config['PID_FILE']:
+        with open(app.config['PID_FILE'], 'w') as pidfile:
+            pidfile.write(str(os.getpid()))
+    gevent.signal_handler(signal.SIGHUP, utils.reload_data)
+    gevent.signal_handler(signal.SIGTERM, server.stop, 30)
+    log.info('Serving on %s:%s', host, port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    main(sys.argv)
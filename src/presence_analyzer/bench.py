@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence data loading and access.
+
+Run with: python -m presence_analyzer.bench [path/to/data.csv]
+
+Speedup of parallel parsing against the number of processes is reported
+by: python -m presence_analyzer.bench parallel [path/to/data.csv]
+
+Benchmark suite loading generated data of given scales and requesting
+API endpoints, with JSON results to compare across commits, runs with:
+
+    python -m presence_analyzer.bench suite [--scales 10k,1m,10m]
+        [--users N] [--requests N] [--output results.json]
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import traceback
+from datetime import datetime
+from functools import partial
+from timeit import default_timer
+
+from presence_analyzer import fixtures
+from presence_analyzer import utils
+from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.index import CsvIndex
+from presence_analyzer.loader import CsvLoader
+from presence_analyzer.main import app
+from presence_analyzer.parsing import parse_csv
+from presence_analyzer.parsing import parse_csv_parallel
+from presence_analyzer.storage import BACKENDS
+from presence_analyzer.utils import get_data
+from presence_analyzer.utils import get_directory
+from presence_analyzer.utils import group_by_weekday
+from presence_analyzer.watcher import FileWatcher
+
+SCALES = {
+    '10k': 10000,
+    '1m': 1000000,
+    '10m': 10000000,
+}
+ENDPOINTS = (
+    '/api/v1/users',
+    '/api/v1/mean_time_weekday/{0}',
+    '/api/v1/presence_weekday/{0}',
+    '/api/v1/presence_start_end/{0}',
+    '/api/v1/median_time_weekday/{0}',
+    '/api/v1/median_start_end/{0}',
+    '/api/v1/get_url_photo/{0}',
+    '/api/v1/organization/week',
+    '/api/v1/bulk?user_id=all',
+)
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns memory used by object and everything it references.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def best_of(func, repeat=5, number=1):
+    """
+    Returns the best time of ``number`` calls to ``func`` in seconds.
+    """
+    timings = []
+    for _ in xrange(repeat):
+        started = default_timer()
+        for _ in xrange(number):
+            func()
+        timings.append((default_timer() - started) / number)
+    return min(timings)
+
+
+def bench_store():
+    """
+    Compares columnar store with nested dict formerly returned by get_data.
+    """
+    store = get_data()
+    legacy = store.to_dict()
+
+    def access_store():
+        """
+        Groups presence of every user like per-user views do.
+        """
+        for user_id in store:
+            group_by_weekday(store[user_id])
+
+    def access_totals():
+        """
+        Reads weekday means of every user from precomputed totals.
+        """
+        for user_id in store:
+            for totals in store.weekdays[user_id]:
+                totals.mean('presence')
+
+    def access_legacy():
+        """
+        Same as above, walking the nested dict.
+        """
+        for items in legacy.itervalues():
+            result = [[], [], [], [], [], [], []]
+            for date, times in items.iteritems():
+                start, end = times['start'], times['end']
+                result[date.weekday()].append(
+                    (end.hour - start.hour) * 3600 +
+                    (end.minute - start.minute) * 60 +
+                    end.second - start.second
+                )
+
+    users = max(len(store), 1)
+    return [
+        ('rows', store.row_count, ''),
+        ('users', len(store), ''),
+        ('store memory', store.nbytes, 'B'),
+        ('legacy dict memory', deep_sizeof(legacy), 'B'),
+        ('store access per user', best_of(access_store) / users * 1e6, 'us'),
+        ('legacy access per user', best_of(access_legacy) / users * 1e6, 'us'),
+        ('totals access per user', best_of(access_totals) / users * 1e6, 'us'),
+    ]
+
+
+def parse_csv_strptime(lines):
+    """
+    Former csv.reader and datetime.strptime loop of get_data.
+    """
+    rows = []
+    for row in csv.reader(lines, delimiter=','):
+        if len(row) != 4:
+            continue
+        try:
+            user_id = int(row[0])
+            date = datetime.strptime(row[1], '%Y-%m-%d').date()
+            start = datetime.strptime(row[2], '%H:%M:%S').time()
+            end = datetime.strptime(row[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            continue
+        rows.append((user_id, date, start, end))
+    return rows
+
+
+def bench_parse():
+    """
+    Compares fixed-format parser with csv and strptime loop.
+    """
+    with open(app.config['DATA_CSV'], 'r') as csvfile:
+        lines = csvfile.readlines()
+
+    fast = best_of(lambda: parse_csv(lines))
+    strptime = best_of(lambda: parse_csv_strptime(lines), repeat=3)
+    return [
+        ('lines', len(lines), ''),
+        ('parse_csv', fast * 1e3, 'ms'),
+        ('csv and strptime', strptime * 1e3, 'ms'),
+        ('speedup', strptime / fast, 'x'),
+    ]
+
+
+def bench_parallel():
+    """
+    Compares serial parsing of whole file with parsing by pools of
+    processes of growing size, up to the number of CPUs.
+    """
+    path = app.config['DATA_CSV']
+    with open(path, 'rb') as csvfile:
+        serial_columns = parse_csv(csvfile)
+
+    def serial():
+        """
+        Parses file in current process.
+        """
+        with open(path, 'rb') as csvfile:
+            parse_csv(csvfile)
+
+    serial_time = best_of(serial, repeat=3)
+    results = [
+        ('cpus', multiprocessing.cpu_count(), ''),
+        ('serial parse', serial_time * 1e3, 'ms'),
+    ]
+    processes = 2
+    while processes <= max(multiprocessing.cpu_count(), 2):
+        if parse_csv_parallel(path, processes) != serial_columns:
+            raise AssertionError('Parallel parse differs from serial one')
+        parallel = best_of(
+            lambda: parse_csv_parallel(path, processes), repeat=3)
+        results.extend([
+            ('{0} processes'.format(processes), parallel * 1e3, 'ms'),
+            ('{0} processes speedup'.format(processes),
+             serial_time / parallel, 'x'),
+        ])
+        processes *= 2
+    return results
+
+
+def report(results):
+    """
+    Prints benchmark results.
+    """
+    for name, value, unit in results:
+        print '{0:<32}{1:>14.1f} {2}'.format(name, value, unit)
+
+
+def max_rss():
+    """
+    Returns high-water mark of memory of current process in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def median(values):
+    """
+    Returns median of non-empty list.
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def in_child(func):
+    """
+    Returns result of ``func`` called in forked process.
+
+    Every scale, and every endpoint of it, is measured in its own process,
+    so memory high-water marks of one do not hide those of another.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 0
+        try:
+            with os.fdopen(write_end, 'w') as pipe:
+                json.dump(func(), pipe)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)  # pylint: disable=protected-access
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        result = pipe.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('Benchmark process failed')
+    return json.loads(result)
+
+
+def cold_load(csv_path, xml_path, snapshot_path):
+    """
+    Times loading of data files by fresh loader, then restoring the
+    snapshot it wrote, and the same for index of user rows. Returns result
+    dict.
+    """
+    app.config.update({
+        'DATA_CSV': csv_path,
+        'DATA_XML': xml_path,
+        'DATA_SNAPSHOT': snapshot_path,
+        'STORAGE_BACKEND': 'csv',
+    })
+    result = {'max_rss_before_kb': max_rss()}
+    for phase in ('parse', 'snapshot_restore'):
+        BACKENDS['csv'].loader = CsvLoader()
+        get_data.cache.mem.clear()
+        started = default_timer()
+        get_data()
+        result[phase + '_s'] = default_timer() - started
+    index_path = snapshot_path + '.index'
+    for phase in ('index_build', 'index_restore'):
+        started = default_timer()
+        CsvIndex().load(csv_path, index_path)
+        result[phase + '_s'] = default_timer() - started
+    started = default_timer()
+    get_directory()
+    result['users_xml_s'] = default_timer() - started
+    result['max_rss_kb'] = max_rss()
+    return result
+
+
+def bench_endpoints(requests):
+    """
+    Requests every endpoint: once per user for cold responses and then
+    ``requests`` times for the same user. Returns dict of results.
+
+    Every endpoint is requested in its own forked process with data
+    already loaded, its ``max_rss_growth_kb`` being how much the memory
+    high-water mark of the process grew while serving it.
+    """
+    client = app.test_client()
+    user_ids = get_data().keys()
+    sampled = user_ids[::max(len(user_ids) // 20, 1)]
+    results = {}
+
+    def timed(url):
+        """
+        Returns duration of request in milliseconds.
+        """
+        started = default_timer()
+        response = client.get(url)
+        response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError('{0} returned {1}'.format(
+                url, response.status_code))
+        return (default_timer() - started) * 1e3
+
+    def measure(endpoint):
+        """
+        Returns results of endpoint.
+        """
+        max_rss_before = max_rss()
+        cold = [timed(endpoint.format(user_id)) for user_id in sampled]
+        url = endpoint.format(sampled[0])
+        warm = [timed(url) for _ in xrange(requests)]
+        return {
+            'cold_median_ms': median(cold),
+            'cold_max_ms': max(cold),
+            'warm_median_ms': median(warm),
+            'warm_max_ms': max(warm),
+            'max_rss_growth_kb': max_rss() - max_rss_before,
+        }
+
+    for endpoint in ENDPOINTS:
+        results[endpoint] = in_child(partial(measure, endpoint))
+    return results
+
+
+def bench_scale(rows, users, requests, workdir):
+    """
+    Generates data of given size and measures it in forked process.
+    """
+    name = 'presence_{0}_{1}'.format(rows, users)
+    csv_path = os.path.join(workdir, name + '.csv')
+    xml_path = os.path.join(workdir, name + '.xml')
+    if not os.path.exists(csv_path):
+        fixtures.generate_csv(csv_path, rows, users)
+    if not os.path.exists(xml_path):
+        fixtures.generate_xml(xml_path, users)
+    snapshot_path = os.path.join(workdir, name + '.snapshot')
+    for path in (snapshot_path, snapshot_path + '.index'):
+        if os.path.exists(path):
+            os.remove(path)
+
+    def measure():
+        """
+        Runs measurements of the scale.
+        """
+        # inotify thread of parent process is not there after fork
+        utils.WATCHER = FileWatcher(app.config['WATCH_INTERVAL'])
+        return {
+            'rows': rows,
+            'users': users,
+            'csv_bytes': os.path.getsize(csv_path),
+            'cold_load': cold_load(csv_path, xml_path, snapshot_path),
+            'endpoints': bench_endpoints(requests),
+        }
+    return in_child(measure)
+
+
+def commit():
+    """
+    Returns current git commit or None.
+    """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def suite(argv):
+    """
+    Runs benchmark suite and writes its JSON results.
+    """
+    parser = argparse.ArgumentParser(prog='presence_analyzer.bench suite')
+    parser.add_argument(
+        '--scales', default='10k',
+        help='comma separated row counts, e.g. 10k,1m,10m or 5000')
+    parser.add_argument(
+        '--users', type=int,
+        help='number of users, by default one per 250 rows (at least 10)')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument(
+        '--workdir', default=os.path.join(
+            tempfile.gettempdir(), 'presence_bench'),
+        help='directory keeping generated files')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'engine': app.config['ANALYTICS_ENGINE'],
+        'started': datetime.utcnow().isoformat(),
+        'scales': [],
+    }
+    for scale in args.scales.split(','):
+        rows = SCALES.get(scale) or int(scale)
+        users = args.users or max(rows // 250, 10)
+        results['scales'].append(
+            bench_scale(rows, users, args.requests, args.workdir))
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=2, sort_keys=True)
+    return results
+
+
+def report_suite(results):
+    """
+    Prints summary of benchmark suite results.
+    """
+    for result in results['scales']:
+        report([
+            ('rows', result['rows'], ''),
+            ('users', result['users'], ''),
+            ('cold parse', result['cold_load']['parse_s'], 's'),
+            ('snapshot restore', result['cold_load']['snapshot_restore_s'],
+             's'),
+            ('index build', result['cold_load']['index_build_s'], 's'),
+            ('index restore', result['cold_load']['index_restore_s'], 's'),
+            ('memory high-water', result['cold_load']['max_rss_kb'], 'kB'),
+        ] + [
+            (endpoint, timings['warm_median_ms'], 'ms')
+            for endpoint, timings in sorted(result['endpoints'].items())
+        ])
+
+
+def main(argv):
+    """
+    Runs all benchmarks.
+    """
+    if len(argv) > 1 and argv[1] == 'suite':
+        report_suite(suite(argv[2:]))
+        return
+    if len(argv) > 1 and argv[1] == 'parallel':
+        if len(argv) > 2:
+            app.config['DATA_CSV'] = argv[2]
+        report(bench_parallel())
+        return
+    if len(argv) > 1:
+        app.config['DATA_CSV'] = argv[1]
+    report(bench_parse())
+    report(bench_store())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
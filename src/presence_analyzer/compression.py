@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Negotiated compression of responses.
+"""
+
+import zlib
+from collections import OrderedDict
+from hashlib import md5
+from threading import Lock
+
+from flask import request
+
+from presence_analyzer.main import app
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None  # pylint: disable=invalid-name
+
+COMPRESSIBLE_MIMETYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+)
+
+
+def gzip_compress(body, level):
+    """
+    Returns body compressed in gzip format.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def brotli_compress(body, level):
+    """
+    Returns body compressed with Brotli.
+    """
+    return brotli.compress(body, quality=level)
+
+
+def iter_gzip(chunks, level):
+    """
+    Yields gzip compressed stream of chunks.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# in order of preference
+COMPRESSORS = [('gzip', gzip_compress)]
+if brotli is not None:
+    COMPRESSORS.insert(0, ('br', brotli_compress))
+
+
+class CompressionCache(object):
+
+    """
+    Keeps compressed bodies of least recently used responses.
+
+    Bodies are identified by their ETag, which for API responses changes
+    with data generation, or by digest of body for responses without one.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.mem = OrderedDict()
+        self.lock = Lock()
+
+    def compress(self, encoding, key, body):
+        """
+        Returns body compressed with given encoding.
+        """
+        key = (encoding, key or md5(body).hexdigest())
+        with self.lock:
+            compressed = self.mem.pop(key, None)
+            if compressed is not None:
+                self.mem[key] = compressed
+                return compressed
+
+        compressed = dict(COMPRESSORS)[encoding](
+            body, app.config['COMPRESS_LEVEL'])
+        with self.lock:
+            self.mem[key] = compressed
+            while len(self.mem) > self.maxsize:
+                self.mem.popitem(last=False)
+        return compressed
+
+
+COMPRESSION_CACHE = CompressionCache(maxsize=1000)
+
+
+def accepted_encoding():
+    """
+    Returns the most preferred encoding accepted by client or None.
+    """
+    for encoding, _ in COMPRESSORS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress_response(response):
+    """
+    Compresses text responses when client accepts it.
+
+    Streamed responses (other than static files) are compressed on the fly
+    with gzip, others whole, taking compressed body from cache if possible.
+    Strong ETag becomes weak, as compressed body is not the same bytes.
+    """
+    encoding = accepted_encoding()
+    if (encoding is None or response.status_code != 200 or
+            'Content-Encoding' in response.headers or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    etag, _ = response.get_etag()
+    if response.is_streamed and not response.direct_passthrough:
+        if not request.accept_encodings['gzip']:
+            return response
+        response.response = iter_gzip(
+            response.response, app.config['COMPRESS_LEVEL'])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+    else:
+        response.direct_passthrough = False
+        body = response.get_data()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(COMPRESSION_CACHE.compress(encoding, etag, body))
+        response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
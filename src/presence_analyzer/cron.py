@@ -1,33 +1,151 @@
 """
 Fetching users.xml file from http://sargo.bolt.stxnext.pl/users.xml
 """
+import json
+import logging
+import os
 import os.path
+import signal
+import tempfile
 import urllib2
-from shutil import move
 
-TMP_DATA_XML = os.path.join(
-    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'tmp_data.xml'
-)
+from lxml import etree
 
-MAIN_DATA_XML = os.path.join(
-    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.xml'
-)
+from presence_analyzer.main import app
+from presence_analyzer.users import UserDirectory
 
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
-def fetch_xml_file(url):
+URL = 'http://sargo.bolt.stxnext.pl/users.xml'
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = 30
+
+
+def fetch_xml_file(url, path=None, pidfile=None):
     """
     Main procedure for fetching users.xml file
+
+    Download is skipped when server says the file did not change since
+    the last fetch. Otherwise it is streamed to a temporary file, which
+    replaces the file at ``path`` at once, only if it holds valid users
+    XML. Then process from ``pidfile`` is asked to reload data.
+
+    Returns "OK" when file was replaced, "NOT MODIFIED" when it was up to
+    date and None on failure.
     """
+    path = path or app.config['MAIN_DATA_XML']
+    validators = read_validators(path)
+    request = urllib2.Request(url)
+    if validators.get('etag'):
+        request.add_header('If-None-Match', validators['etag'])
+    if validators.get('last_modified'):
+        request.add_header('If-Modified-Since', validators['last_modified'])
+
     try:
-        result = urllib2.urlopen(url)
-        html = result.read()
-        with open(TMP_DATA_XML, 'w+') as tmpfile:
-            tmpfile.write(html)
-            move(TMP_DATA_XML, MAIN_DATA_XML)
-            return "OK"
+        result = urllib2.urlopen(request, timeout=TIMEOUT)
+    except urllib2.HTTPError, err:
+        if err.code == 304:
+            log.debug('%s not modified', url)
+            return "NOT MODIFIED"
+        log.warning('Cannot fetch %s: %s', url, err)
+        return None
     except urllib2.URLError, err:
-        print err
+        log.warning('Cannot fetch %s: %s', url, err)
+        return None
+
+    directory = os.path.dirname(os.path.abspath(path))
+    descriptor, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.users.', suffix='.xml.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as tmpfile:
+            for chunk in iter(lambda: result.read(CHUNK_SIZE), ''):
+                tmpfile.write(chunk)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        if not is_valid(tmp_path):
+            log.warning('Invalid users XML fetched from %s', url)
+            return None
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        log.warning('Cannot save %s', path, exc_info=True)
+        return None
+    finally:
+        result.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    sync_directory(directory)
+
+    write_validators(path, {
+        'etag': result.info().getheader('ETag'),
+        'last_modified': result.info().getheader('Last-Modified'),
+    })
+    if pidfile:
+        signal_reload(pidfile)
+    return "OK"
+
+
+def is_valid(path):
+    """
+    Checks if file is well formed users XML with at least one user.
+    """
+    try:
+        return len(UserDirectory.from_xml(path)) > 0
+    except etree.XMLSyntaxError:  # pylint: disable=no-member
+        return False
+
+
+def sync_directory(directory):
+    """
+    Flushes directory entries, so the rename survives a crash.
+    """
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    except OSError:  # pragma: no cover
+        pass
+    finally:
+        os.close(descriptor)
+
+
+def read_validators(path):
+    """
+    Returns ETag and Last-Modified headers of the last fetch of file.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path + '.validators') as validators:
+            return json.load(validators)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_validators(path, validators):
+    """
+    Remembers ETag and Last-Modified headers of fetched file.
+
+    Headers are used only while the fetched file is there, so a removed
+    file is downloaded again.
+    """
+    try:
+        with open(path + '.validators', 'w') as validators_file:
+            json.dump(validators, validators_file)
+    except IOError:
+        log.warning('Cannot save validators of %s', path, exc_info=True)
+
+
+def signal_reload(pidfile):
+    """
+    Sends SIGHUP to process with id read from given file.
+    """
+    try:
+        with open(pidfile) as pid:
+            os.kill(int(pid.read().strip()), signal.SIGHUP)
+    except (IOError, OSError, ValueError):
+        log.warning('Cannot signal reload to %s', pidfile, exc_info=True)
 
 
 if __name__ == '__main__':
-    fetch_xml_file("http://sargo.bolt.stxnext.pl/users.xml")
+    logging.basicConfig(level=logging.INFO)
+    fetch_xml_file(URL, pidfile=app.config['PID_FILE'])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Analytics engines computing weekday totals of all users in a store.
+
+Engine is chosen with ANALYTICS_ENGINE config option.
+"""
+
+from presence_analyzer.store import WeekdayTotals
+from presence_analyzer.store import weekday_totals
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+
+def python_engine(store):
+    """
+    Sums rows of every user in pure Python.
+    """
+    return dict(
+        (user_id, weekday_totals(store[user_id]))
+        for user_id in store.offsets
+    )
+
+
+def numpy_engine(store):
+    """
+    Sums rows of all users at once with numpy.bincount.
+
+    Every row gets bin ``user_index * 7 + weekday``, so each of count,
+    presence, start and end sums is a single bincount over all rows.
+    """
+    if numpy is None:
+        raise ImportError('numpy engine requires numpy package')
+    if not store.row_count:
+        return {}
+
+    user_ids, days, starts, ends = [
+        numpy.frombuffer(column, dtype=numpy.int32).astype(numpy.int64)
+        for column in store.columns
+    ]
+    users = numpy.unique(user_ids)
+    bins = numpy.searchsorted(users, user_ids) * 7 + (days - 1) % 7
+    size = len(users) * 7
+    sums = numpy.column_stack([
+        numpy.bincount(bins, minlength=size),
+        numpy.bincount(bins, weights=ends - starts, minlength=size),
+        numpy.bincount(bins, weights=starts, minlength=size),
+        numpy.bincount(bins, weights=ends, minlength=size),
+    ]).astype(numpy.int64).reshape(len(users), 7, 4)
+
+    return dict(
+        (user_id, tuple(WeekdayTotals(*totals) for totals in weekdays))
+        for user_id, weekdays in zip(users.tolist(), sums.tolist())
+    )
+
+
+ENGINES = {
+    'python': python_engine,
+    'numpy': numpy_engine,
+}
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic generator of synthetic presence data.
+
+Generated files have the formats of ``sample_data.csv`` and
+``sample_data.xml``, so they can be loaded in place of real exports.
+"""
+
+import datetime
+import random
+from itertools import islice
+
+FIRST_DAY = datetime.date(2011, 6, 1)
+FIRST_NAMES = (
+    'Adam', 'Agata', 'Andrzej', 'Anna', 'Artur', 'Damian', 'Dawid', 'Ewa',
+    'Jan', 'Kamil', 'Katarzyna', 'Maciej', 'Marta', 'Piotr', 'Tomasz',
+)
+LETTERS = 'ABCDEFGHIJKLMNOPRSTWZ'
+USER_ID_OFFSET = 10
+
+
+def user_ids(users):
+    """
+    Returns ids of given number of users.
+    """
+    return range(USER_ID_OFFSET, USER_ID_OFFSET + users)
+
+
+def workdays(first=FIRST_DAY):
+    """
+    Yields dates of consecutive working days.
+    """
+    day = first
+    while True:
+        if day.weekday() < 5:
+            yield day
+        day += datetime.timedelta(days=1)
+
+
+def format_time(seconds):
+    """
+    Returns HH:MM:SS of seconds since midnight.
+    """
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+def generate_rows(rows, users, seed=0):
+    """
+    Yields ``rows`` CSV lines of ``users`` users, ordered by user and day
+    like presence exports are.
+
+    Rows are spread evenly, every user gets consecutive working days from
+    FIRST_DAY. Same arguments always give the same lines.
+    """
+    generator = random.Random(seed)
+    per_user, extra = divmod(rows, users)
+    for index, user_id in enumerate(user_ids(users)):
+        count = per_user + (1 if index < extra else 0)
+        for day in islice(workdays(), count):
+            start = generator.randint(7 * 3600, 10 * 3600)
+            end = start + generator.randint(6 * 3600, 10 * 3600)
+            yield '{0},{1},{2},{3}\n'.format(
+                user_id, day.isoformat(), format_time(start),
+                format_time(end))
+
+
+def generate_csv(path, rows, users, seed=0):
+    """
+    Writes CSV file of ``rows`` presence rows of ``users`` users.
+    """
+    with open(path, 'w') as csvfile:
+        csvfile.writelines(generate_rows(rows, users, seed))
+
+
+def generate_xml(path, users, seed=0):
+    """
+    Writes users XML file with given number of users.
+    """
+    generator = random.Random(seed)
+    with open(path, 'w') as xmlfile:
+        xmlfile.write(
+            '<?xml version="1.0" encoding="UTF-8" ?>\n'
+            '<intranet>\n'
+            '    <server>\n'
+            '        <host>intranet.stxnext.pl</host>\n'
+            '        <port>443</port>\n'
+            '        <protocol>https</protocol>\n'
+            '    </server>\n'
+            '    <users>\n'
+        )
+        for user_id in user_ids(users):
+            xmlfile.write(
+                '        <user id="{0}">\n'
+                '            <avatar>/api/images/users/{0}</avatar>\n'
+                '            <name>{1} {2}.</name>\n'
+                '        </user>\n'.format(
+                    user_id, generator.choice(FIRST_NAMES),
+                    generator.choice(LETTERS))
+            )
+        xmlfile.write(
+            '    </users>\n'
+            '</intranet>\n'
+        )
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Index of user rows in presence CSV file.
+
+Index maps every user id to byte ranges of the file holding lines of that
+user, so rows of a single user are read and parsed without loading the
+whole file. Exports are ordered by user, so most users have one range.
+
+Index file holds a header describing the source CSV file (see
+presence_analyzer.source) and number of ranges followed by
+``(user_id, start, stop, lines)`` records of all ranges.
+"""
+
+import logging
+import os
+import struct
+from collections import OrderedDict
+from threading import Lock
+
+from presence_analyzer.metrics import LOAD_DURATION
+from presence_analyzer.metrics import LOADED_ROWS
+from presence_analyzer.parsing import parse_csv
+from presence_analyzer.source import Source
+from presence_analyzer.source import read_header
+from presence_analyzer.source import write as write_derived
+from presence_analyzer.store import GENERATIONS
+from presence_analyzer.store import PresenceStore
+from presence_analyzer.store import WeekdayTotals
+from presence_analyzer.store import weekday_sketches
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESINDX'
+VERSION = 2
+# number of ranges
+COUNT = struct.Struct('=q')
+RANGE = struct.Struct('=iqqi')
+# parsed users kept by every LazyCsvStore
+CACHED_USERS = 1000
+
+
+def write(path, ranges, source):
+    """
+    Writes index of given Source.
+    """
+    records = [
+        RANGE.pack(user_id, start, stop, lines)
+        for user_id in sorted(ranges)
+        for start, stop, lines in ranges[user_id]
+    ]
+    write_derived(
+        path, MAGIC, VERSION, source,
+        [COUNT.pack(len(records)), ''.join(records)])
+
+
+def read(path, source_path, stat):
+    """
+    Returns ``(ranges, source)`` from index of file at ``source_path`` with
+    given stat, ``source`` being Source the index was made from.
+
+    Returns None when index is missing or was made from other file. Index
+    of a file that grew since is still valid, only lines appended after
+    ``source.offset`` are missing in it.
+    """
+    try:
+        index = open(path, 'rb')
+    except IOError:
+        return None
+
+    with index:
+        source = read_header(index, MAGIC, VERSION, source_path, stat)
+        if source is None:
+            return None
+        count = index.read(COUNT.size)
+        if len(count) != COUNT.size:
+            return None
+        count, = COUNT.unpack(count)
+        records = index.read(RANGE.size * count)
+    if len(records) != RANGE.size * count:
+        log.warning('Index %s is truncated', path)
+        return None
+
+    ranges = {}
+    for i in xrange(0, len(records), RANGE.size):
+        user_id, start, stop, lines = RANGE.unpack_from(records, i)
+        ranges[user_id] = ranges.get(user_id, ()) + ((start, stop, lines),)
+    return ranges, source
+
+
+class CsvIndex(object):
+
+    """
+    Keeps index of presence CSV file in step with lines appended to it.
+
+    Like CsvLoader, index remembers Source of the file, scans only lines
+    appended after its offset and starts over when the file no longer
+    matches it (was replaced, truncated or rewritten). Index is saved
+    after every change, if path for it is given, and fresh CsvIndex (e.g.
+    in new worker) reads it instead of scanning the whole file.
+
+    Scanning reads only user ids of lines, other fields are parsed when
+    rows of a user are queried.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.source = None
+        self.offset = 0
+        self.ranges = {}
+        self.store = None
+        self.lock = Lock()
+
+    def load(self, path, index_path=None):
+        """
+        Returns LazyCsvStore with current content of CSV file at given path.
+        """
+        with self.lock:
+            stat = os.stat(path)
+            if (self.store is None or path != self.path or
+                    not self.source.matches(path, stat)):
+                self.path = path
+                self.store = None
+                if not self._restore(index_path, stat):
+                    self.offset = 0
+                    self.ranges = {}
+                    self._scan(path, 'csv_index')
+                    self.source = Source.of(path, stat, self.offset)
+                    self._save(index_path)
+
+            offset = self.offset
+            if stat.st_size > offset:
+                self._scan(path, 'csv_index_append')
+            self.source = Source.of(path, stat, self.offset)
+            if self.offset != offset:
+                self.store = None
+                self._save(index_path)
+
+            if self.store is None:
+                self.store = LazyCsvStore(path, self.ranges, self.source)
+                log.debug(
+                    'Indexed %d rows of %d users from %s',
+                    self.store.row_count, len(self.store), path
+                )
+            return self.store
+
+    def _restore(self, index_path, stat):
+        """
+        Reads ranges and source from index file. Returns False if it failed.
+        """
+        restored = None
+        if index_path:
+            with LOAD_DURATION.time(('csv_index_restore',)):
+                restored = read(index_path, self.path, stat)
+        if restored is None:
+            return False
+        self.ranges, self.source = restored
+        self.offset = self.source.offset
+        return True
+
+    def _save(self, index_path):
+        """
+        Writes index file, logging failures.
+        """
+        if not index_path:
+            return
+        try:
+            write(index_path, self.ranges, self.source)
+        except (IOError, OSError):
+            log.warning('Cannot write index %s', index_path, exc_info=True)
+
+    def _scan(self, path, phase):
+        """
+        Adds ranges of complete lines after remembered offset and moves
+        the offset forward.
+
+        Consecutive lines of a user make one range, which is extended when
+        appended lines continue it. Lines not starting with a user id
+        (header, footer) are left out.
+        """
+        runs = []
+        run = None
+        with LOAD_DURATION.time((phase,)), open(path, 'rb') as csvfile:
+            csvfile.seek(self.offset)
+            position = self.offset
+            for line in csvfile:
+                if not line.endswith('\n'):
+                    break
+                start = position
+                position += len(line)
+                comma = line.find(',')
+                if comma < 1:
+                    continue
+                try:
+                    user_id = int(line[:comma])
+                except ValueError:
+                    continue
+                if run is not None and run[0] == user_id and run[2] == start:
+                    run[2] = position
+                    run[3] += 1
+                else:
+                    run = [user_id, start, position, 1]
+                    runs.append(run)
+
+        ranges = dict(self.ranges)
+        for user_id, start, stop, lines in runs:
+            user_ranges = ranges.get(user_id, ())
+            if user_ranges and user_ranges[-1][1] == start:
+                first, _, indexed = user_ranges[-1]
+                user_ranges = user_ranges[:-1] + (
+                    (first, stop, indexed + lines),)
+            else:
+                user_ranges += ((start, stop, lines),)
+            ranges[user_id] = user_ranges
+        self.ranges = ranges
+        self.offset = position
+        LOADED_ROWS.inc((phase,), sum(run[3] for run in runs))
+
+
+class LazyCsvStore(object):
+
+    """
+    Presence data read from CSV file user by user, using ranges of CsvIndex.
+
+    Only the index is kept in memory. Lines of a user are read and parsed
+    into PresenceStore without rollup cube on first query, stores of up to
+    ``cached_users`` recently queried users are kept. Organization-wide
+    rollup cube needs all rows, so whole file is parsed on its first use.
+    """
+
+    def __init__(self, path, ranges, source=None, cached_users=CACHED_USERS):
+        """
+        Takes path of CSV file, dict mapping user id to tuple of
+        ``(start, stop, lines)`` byte ranges of user's lines and Source of
+        the indexed file, kept as ``identity``.
+        """
+        self.path = path
+        self.ranges = ranges
+        self.identity = source
+        self.mtime = source.mtime if source is not None else None
+        self.cached_users = cached_users
+        self.generation = next(GENERATIONS)
+        self.user_ids = sorted(ranges)
+        self.row_count = sum(
+            lines for user_ranges in ranges.itervalues()
+            for _, _, lines in user_ranges
+        )
+        self.stores = OrderedDict()
+        self.lock = Lock()
+        self.cube = None
+        self.cube_lock = Lock()
+
+    def __contains__(self, user_id):
+        return user_id in self.ranges
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __getitem__(self, user_id):
+        """
+        Returns list of ``(day, start, end)`` rows of given user.
+        """
+        store = self.user_store(user_id)
+        return store[user_id] if user_id in store else []
+
+    def weekday_totals(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdayTotals of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+        """
+        store = self.user_store(user_id)
+        if user_id not in store:
+            return (WeekdayTotals(0, 0, 0, 0),) * 7
+        return store.weekday_totals(user_id, first, last)
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdaySketches of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+        """
+        store = self.user_store(user_id)
+        if user_id not in store:
+            return weekday_sketches(())
+        return store.weekday_sketches(user_id, first, last)
+
+    def keys(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return list(self.user_ids)
+
+    @property
+    def rollup(self):
+        """
+        RollupCube of all indexed rows.
+        """
+        with self.cube_lock:
+            if self.cube is None:
+                ranges = sorted(
+                    user_range for user_ranges in self.ranges.itervalues()
+                    for user_range in user_ranges
+                )
+                self.cube = PresenceStore.from_columns(
+                    *parse_csv(self.read(ranges))).rollup
+        return self.cube
+
+    def user_store(self, user_id):
+        """
+        Returns PresenceStore of rows of given user, parsing them on first
+        call. Raises KeyError for users missing in the index.
+        """
+        ranges = self.ranges[user_id]
+        with self.lock:
+            store = self.stores.pop(user_id, None)
+            if store is not None:
+                self.stores[user_id] = store
+                return store
+
+        store = PresenceStore.from_columns(
+            *parse_csv(self.read(ranges)), build_rollup=False)
+        with self.lock:
+            self.stores[user_id] = store
+            while len(self.stores) > self.cached_users:
+                self.stores.popitem(last=False)
+        return store
+
+    def read(self, ranges):
+        """
+        Yields lines of given byte ranges of the file.
+        """
+        with open(self.path, 'rb') as csvfile:
+            for start, stop, _ in ranges:
+                csvfile.seek(start)
+                for line in csvfile.read(stop - start).splitlines():
+                    yield line
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental loading of presence CSV file.
+"""
+
+import logging
+import os
+from multiprocessing import cpu_count
+from threading import Lock
+
+from presence_analyzer import snapshot
+from presence_analyzer.metrics import LOAD_DURATION
+from presence_analyzer.metrics import LOADED_ROWS
+from presence_analyzer.parsing import parse_csv
+from presence_analyzer.parsing import parse_csv_parallel
+from presence_analyzer.source import Source
+from presence_analyzer.store import PresenceStore
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# smaller parts of file are not worth starting processes for
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+
+class CsvLoader(object):
+
+    """
+    Loads presence CSV file into PresenceStore.
+
+    Presence exports are append-only, so loader remembers Source of the
+    parsed file (see presence_analyzer.source), offset of its last complete
+    line included. Next load parses only bytes appended after that offset
+    and merges them into the store. Whole file is parsed again when it no
+    longer matches the Source: was replaced, truncated or rewritten.
+
+    After parsing whole file loader writes its snapshot, if path for it is
+    given. Fresh loader (e.g. in new worker) reads the snapshot instead of
+    parsing the file and then parses only lines appended since.
+
+    With ``processes`` other than 1 (0 meaning one per CPU) big files are
+    parsed in chunks by a pool of processes.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.engine = None
+        self.source = None
+        self.offset = 0
+        self.store = None
+        self.lock = Lock()
+
+    def load(self, path, engine=None, snapshot_path=None, processes=1):
+        """
+        Returns store with current content of CSV file at given path.
+
+        Weekday totals of the store are computed by given engine. Every new
+        store gets Source of the file it was loaded from as ``identity``.
+        """
+        processes = processes or cpu_count()
+        with self.lock:
+            stat = os.stat(path)
+            if (self.store is None or path != self.path or
+                    engine is not self.engine or
+                    not self.source.matches(path, stat)):
+                self.path = path
+                self.engine = engine
+                if not self._restore(snapshot_path, stat):
+                    self.offset = 0
+                    self.store = self._parse(path, stat, processes, 'csv')
+                    self.source = Source.of(path, stat, self.offset)
+                    self.store.identity = self.source
+                    log.debug(
+                        'Loaded %d rows of %d users from %s (%d bytes)',
+                        self.store.row_count, len(self.store), path,
+                        self.store.nbytes
+                    )
+                    self._save(snapshot_path)
+                    return self.store
+
+            if stat.st_size > self.offset:
+                offset = self.offset
+                appended = self._parse(
+                    path, stat, processes, 'csv_append')
+                self.store = self.store.merge(appended)
+                log.debug(
+                    'Merged %d rows from %d appended bytes of %s',
+                    appended.row_count, self.offset - offset, path
+                )
+            self.source = Source.of(path, stat, self.offset)
+            if self.store.identity is None:
+                self.store.identity = self.source
+            return self.store
+
+    def _restore(self, snapshot_path, stat):
+        """
+        Reads store and source from snapshot. Returns False if it failed.
+        """
+        restored = None
+        if snapshot_path:
+            with LOAD_DURATION.time(('snapshot_restore',)):
+                restored = snapshot.read(
+                    snapshot_path, self.path, stat, self.engine)
+        if restored is None:
+            return False
+
+        self.store, self.source = restored
+        self.offset = self.source.offset
+        LOADED_ROWS.inc(('snapshot_restore',), self.store.row_count)
+        log.debug(
+            'Restored %d rows of %d users from %s',
+            self.store.row_count, len(self.store), snapshot_path
+        )
+        return True
+
+    def _save(self, snapshot_path):
+        """
+        Writes snapshot of loaded store, logging failures.
+        """
+        if not snapshot_path:
+            return
+        try:
+            with LOAD_DURATION.time(('snapshot_write',)):
+                snapshot.write(snapshot_path, self.store, self.source)
+        except (IOError, OSError):
+            log.warning('Cannot write snapshot %s', snapshot_path,
+                        exc_info=True)
+
+    def _parse(self, path, stat, processes, phase):
+        """
+        Parses file from remembered offset and moves the offset forward.
+
+        Duration and rows are recorded in metrics of given load phase.
+        """
+        with LOAD_DURATION.time((phase,)), open(path, 'rb') as csvfile:
+            if (processes > 1 and
+                    stat.st_size - self.offset >= PARALLEL_MIN_BYTES):
+                columns = parse_csv_parallel(
+                    path, processes, self.offset, stat.st_size)
+                self.offset = self._last_line_end(csvfile, stat.st_size)
+            else:
+                csvfile.seek(self.offset)
+                columns = parse_csv(self._complete_lines(csvfile))
+            store = PresenceStore.from_columns(*columns, engine=self.engine)
+        store.mtime = stat.st_mtime
+        LOADED_ROWS.inc((phase,), store.row_count)
+        return store
+
+    def _last_line_end(self, csvfile, size, block=64 * 1024):
+        """
+        Returns offset after the last newline before ``size`` byte of file,
+        the remembered offset if there is none.
+        """
+        stop = size
+        while stop > self.offset:
+            start = max(stop - block, self.offset)
+            csvfile.seek(start)
+            newline = csvfile.read(stop - start).rfind('\n')
+            if newline >= 0:
+                return start + newline + 1
+            stop = start
+        return self.offset
+
+    def _complete_lines(self, csvfile):
+        """
+        Yields lines of file counting bytes of newline terminated ones.
+
+        Unterminated last line is parsed as well, but offset stays before
+        it, so it is parsed again once writer finishes it.
+        """
+        for line in csvfile:
+            if line.endswith('\n'):
+                self.offset += len(line)
+            yield line
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics exposed in Prometheus text format.
+
+Metrics live in memory of a process, so every worker of pre-fork server
+reports its own values.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import time as timer
+
+# seconds, from sub-millisecond cache hits to full reloads of big files
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+
+def format_labels(names, values, extra=()):
+    """
+    Returns ``{name="value",...}`` label set, empty string for no labels.
+    """
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+        for name, value in pairs
+    ))
+
+
+def format_value(value):
+    """
+    Returns sample value as Prometheus float.
+    """
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+
+    """
+    Base of metrics with values per label values.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def samples(self):
+        """
+        Yields ``(name, labels, value)`` samples.
+        """
+        for label_values, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+    def render(self):
+        """
+        Returns metric in text exposition format.
+        """
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.documentation),
+            '# TYPE {0} {1}'.format(self.name, self.kind),
+        ]
+        lines.extend(
+            '{0}{1} {2}'.format(name, labels, format_value(value))
+            for name, labels, value in self.samples()
+        )
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    """
+    Monotonically growing value.
+    """
+
+    kind = 'counter'
+
+    def inc(self, label_values=(), amount=1):
+        """
+        Adds amount to value of given labels.
+        """
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+
+class Histogram(Metric):
+
+    """
+    Distribution of observed values in cumulative buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, label_values=()):
+        """
+        Records observed value under given labels.
+        """
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = \
+                    [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, label_values=()):
+        """
+        Observes duration of the with block.
+        """
+        started = timer()
+        try:
+            yield
+        finally:
+            self.observe(timer() - started, label_values)
+
+    def samples(self):
+        """
+        Yields bucket, sum and count samples.
+        """
+        with self.lock:
+            values = sorted(
+                (labels, list(counts)) for labels, counts in
+                self.values.iteritems())
+        for label_values, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield self.name + '_bucket', format_labels(
+                    self.labels, label_values,
+                    [('le', format_value(bound))]), total
+            labels = format_labels(self.labels, label_values)
+            yield self.name + '_sum', labels, counts[-1]
+            yield self.name + '_count', labels, total
+
+
+class Collected(Metric):
+
+    """
+    Metric read from callback at exposition time, for values which are
+    already counted elsewhere.
+
+    Callback returns iterable of ``(label_values, value)`` pairs.
+    """
+
+    def __init__(self, name, documentation, kind, callback, labels=()):
+        Metric.__init__(self, name, documentation, labels)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        """
+        Yields samples returned by callback.
+        """
+        for label_values, value in sorted(self.callback()):
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Registry(object):
+
+    """
+    Collection of metrics exposed together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """
+        Adds metric to registry. Returns the metric.
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Returns all metrics in text exposition format.
+        """
+        return ''.join(metric.render() + '\n' for metric in self.metrics)
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'presence_request_duration_seconds',
+    'Time spent handling requests, by endpoint and status.',
+    labels=('endpoint', 'status'),
+))
+LOAD_DURATION = REGISTRY.register(Histogram(
+    'presence_load_duration_seconds',
+    'Time spent loading data files, by phase.',
+    labels=('phase',),
+))
+LOADED_ROWS = REGISTRY.register(Counter(
+    'presence_loaded_rows_total',
+    'Rows of data files loaded, by phase.',
+    labels=('phase',),
+))
+CACHE_COMPUTE_DURATION = REGISTRY.register(Histogram(
+    'presence_cache_compute_duration_seconds',
+    'Time spent computing values of cached functions.',
+    labels=('function',),
+))
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parser of presence CSV files.
+
+Lines have fixed ``user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS`` layout, so
+fields are sliced and converted with int() instead of datetime.strptime.
+Distinct dates and times are few compared to rows, so every parsed
+value is memoized.
+
+Big files can be split into newline aligned byte ranges parsed by a pool
+of processes, see parse_csv_parallel.
+"""
+
+import datetime
+import logging
+import os
+from array import array
+from multiprocessing import Pool
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def parse_date(text):
+    """
+    Converts YYYY-MM-DD string to date ordinal.
+    """
+    if len(text) != 10 or text[4] != '-' or text[7] != '-':
+        raise ValueError('Invalid date: {0!r}'.format(text))
+    return datetime.date(
+        int(text[:4]), int(text[5:7]), int(text[8:])
+    ).toordinal()
+
+
+def parse_time(text):
+    """
+    Converts HH:MM:SS string to seconds since midnight.
+    """
+    if len(text) != 8 or text[2] != ':' or text[5] != ':':
+        raise ValueError('Invalid time: {0!r}'.format(text))
+    time = datetime.time(int(text[:2]), int(text[3:5]), int(text[6:]))
+    return time.hour * 3600 + time.minute * 60 + time.second
+
+
+def parse_csv(lines):
+    """
+    Parses presence lines into (user_ids, days, starts, ends) int32 arrays.
+
+    Lines without four fields (header, footer) are skipped silently,
+    lines with malformed fields are skipped and logged.
+    """
+    user_ids = array('i')
+    days = array('i')
+    starts = array('i')
+    ends = array('i')
+    dates = {}
+    times = {}
+
+    for i, line in enumerate(lines):
+        row = line.rstrip('\r\n').split(',')
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            user_id = int(row[0])
+            day = dates.get(row[1])
+            if day is None:
+                day = dates[row[1]] = parse_date(row[1])
+            start = times.get(row[2])
+            if start is None:
+                start = times[row[2]] = parse_time(row[2])
+            end = times.get(row[3])
+            if end is None:
+                end = times[row[3]] = parse_time(row[3])
+            user_ids.append(user_id)  # raises OverflowError above int32
+        except (ValueError, TypeError, OverflowError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+
+        days.append(day)
+        starts.append(start)
+        ends.append(end)
+
+    return user_ids, days, starts, ends
+
+
+def chunk_ranges(csvfile, chunks, start=0, stop=None):
+    """
+    Splits bytes of open file from ``start`` to ``stop`` (end of file by
+    default) into at most ``chunks`` ``(start, stop)`` ranges of whole
+    lines.
+    """
+    if stop is None:
+        stop = os.fstat(csvfile.fileno()).st_size
+    bounds = [start]
+    for i in xrange(1, chunks):
+        position = start + (stop - start) * i // chunks
+        if position <= bounds[-1]:
+            continue
+        csvfile.seek(position - 1)
+        csvfile.readline()  # move to the start of next line
+        position = csvfile.tell()
+        if bounds[-1] < position < stop:
+            bounds.append(position)
+    bounds.append(stop)
+    return zip(bounds, bounds[1:])
+
+
+def read_lines(csvfile, start, stop, block=16 * 1024 * 1024):
+    """
+    Yields lines (without newlines) of bytes from ``start`` to ``stop``
+    of open file, reading it in big blocks.
+    """
+    csvfile.seek(start)
+    remaining = stop - start
+    tail = ''
+    while remaining > 0:
+        data = csvfile.read(min(block, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        lines = (tail + data).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+def parse_range(job):
+    """
+    Parses lines of ``(path, start, stop)`` byte range. Returns column
+    arrays as strings, which are cheap to send between processes.
+    """
+    path, start, stop = job
+    with open(path, 'rb') as csvfile:
+        columns = parse_csv(read_lines(csvfile, start, stop))
+    return [column.tostring() for column in columns]
+
+
+def parse_csv_parallel(path, processes, start=0, stop=None):
+    """
+    Parses file from ``start`` to ``stop`` byte in a pool of processes.
+
+    Each process parses one range of whole lines and column arrays are
+    joined in file order, so result is identical to parse_csv of the same
+    lines.
+    """
+    with open(path, 'rb') as csvfile:
+        ranges = chunk_ranges(csvfile, processes, start, stop)
+    columns = tuple(array('i') for _ in xrange(4))
+    if len(ranges) < 2:
+        jobs = [parse_range((path, first, last)) for first, last in ranges]
+    else:
+        pool = Pool(len(ranges))
+        try:
+            jobs = pool.map(
+                parse_range, [(path, first, last) for first, last in ranges])
+        finally:
+            pool.close()
+            pool.join()
+    for parsed in jobs:
+        for column, data in zip(columns, parsed):
+            column.fromstring(data)
+    return columns
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+Rollup cube of presence data.
+
+Cube aggregates rows of every user by weekday, ISO week and month of their
+days. Each cell holds number of days, sum of presence time, the earliest
+start (first in) and the latest end (last out), so cells of disjoint sets
+of rows are merged by adding and comparing them. Organization totals are
+kept next to cells of users, totals of a group of users are rolled up from
+cells of its members once per cube.
+"""
+
+import calendar
+import datetime
+from array import array
+from collections import namedtuple
+from threading import Lock
+
+DIMENSIONS = ('weekday', 'week', 'month')
+
+
+class Cell(namedtuple('Cell', 'count presence first_in last_out')):
+
+    """
+    Aggregates of rows in one cell of the cube.
+    """
+
+    __slots__ = ()
+
+    def merge(self, other):
+        """
+        Returns cell of rows of both cells.
+        """
+        return Cell(
+            self.count + other.count,
+            self.presence + other.presence,
+            min(self.first_in, other.first_in),
+            max(self.last_out, other.last_out),
+        )
+
+    def mean(self):
+        """
+        Returns mean presence time. Zero when there are no days.
+        """
+        return float(self.presence) / self.count if self.count else 0
+
+
+def day_codes(day):
+    """
+    Returns weekday (Monday is 0), ISO week as ``year * 100 + week`` and
+    month as ``year * 100 + month`` of given date ordinal.
+    """
+    date = datetime.date.fromordinal(day)
+    year, week, _ = date.isocalendar()
+    return date.weekday(), year * 100 + week, date.year * 100 + date.month
+
+
+def format_code(dimension, code):
+    """
+    Returns label of cell: weekday abbreviation, ``YYYY-Www`` or
+    ``YYYY-MM``.
+    """
+    if dimension == 'week':
+        return '{0}-W{1:02d}'.format(*divmod(code, 100))
+    if dimension == 'month':
+        return '{0}-{1:02d}'.format(*divmod(code, 100))
+    return calendar.day_abbr[code]
+
+
+def rollup_rows(rows, codes=None):
+    """
+    Aggregates ``(day, start, end)`` rows. Returns tuple of dicts mapping
+    codes of DIMENSIONS to Cells.
+
+    Codes of days are memoized in ``codes`` dict, if given.
+    """
+    codes = {} if codes is None else codes
+    cells = ({}, {}, {})
+    for day, start, end in rows:
+        keys = codes.get(day)
+        if keys is None:
+            keys = codes[day] = day_codes(day)
+        for dimension, key in zip(cells, keys):
+            cell = dimension.get(key)
+            if cell is None:
+                dimension[key] = [1, end - start, start, end]
+            else:
+                cell[0] += 1
+                cell[1] += end - start
+                if start < cell[2]:
+                    cell[2] = start
+                if end > cell[3]:
+                    cell[3] = end
+    return tuple(
+        dict((key, Cell(*cell)) for key, cell in dimension.iteritems())
+        for dimension in cells
+    )
+
+
+def fold_cells(target, cells):
+    """
+    Merges tuple of dicts of cells into ``target`` tuple of dicts.
+    """
+    for mine, theirs in zip(target, cells):
+        for key, cell in theirs.iteritems():
+            other = mine.get(key)
+            mine[key] = cell if other is None else other.merge(cell)
+
+
+def merge_cells(first, second):
+    """
+    Returns tuple of dicts with cells of both tuples of dicts.
+    """
+    merged = tuple(dict(dimension) for dimension in first)
+    fold_cells(merged, second)
+    return merged
+
+
+class RollupTable(object):
+
+    """
+    Cells of many users packed in parallel arrays.
+
+    Cells of a user are sorted by dimension and code, ``blocks`` maps user
+    id to boundaries of cells of every dimension.
+    """
+
+    typecodes = ('i', 'i', 'l', 'i', 'i')
+
+    def __init__(self, columns=None, blocks=None):
+        """
+        Takes (codes, counts, presences, first ins, last outs) arrays and
+        blocks of users.
+        """
+        self.columns = columns or tuple(
+            array(typecode) for typecode in self.typecodes)
+        self.blocks = {} if blocks is None else blocks
+
+    def __contains__(self, user_id):
+        return user_id in self.blocks
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def add(self, user_id, cells):
+        """
+        Appends cells of given user, tuple of dicts returned by
+        rollup_rows.
+        """
+        blocks = [len(self)]
+        for dimension in cells:
+            for key in sorted(dimension):
+                self.columns[0].append(key)
+                for column, value in zip(self.columns[1:], dimension[key]):
+                    column.append(value)
+            blocks.append(len(self))
+        self.blocks[user_id] = tuple(blocks)
+
+    def copy(self, other, user_id):
+        """
+        Appends cells of given user from other table.
+        """
+        blocks = other.blocks[user_id]
+        shift = len(self) - blocks[0]
+        for column, source in zip(self.columns, other.columns):
+            column.fromstring(source[blocks[0]:blocks[-1]].tostring())
+        self.blocks[user_id] = tuple(block + shift for block in blocks)
+
+    def get(self, user_id):
+        """
+        Returns cells of given user as tuple of dicts.
+        """
+        blocks = self.blocks[user_id]
+        columns = [
+            column[blocks[0]:blocks[-1]].tolist() for column in self.columns
+        ]
+        rows = zip(*columns)
+        return tuple(
+            dict((row[0], Cell(*row[1:]))
+                 for row in rows[lower - blocks[0]:upper - blocks[0]])
+            for lower, upper in zip(blocks, blocks[1:])
+        )
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by packed cells and their blocks.
+        """
+        block_entry = 24 + 8 * (len(DIMENSIONS) + 1)  # key and tuple
+        return (
+            sum(column.itemsize * len(column) for column in self.columns) +
+            block_entry * len(self.blocks)
+        )
+
+
+class RollupCube(object):
+
+    """
+    Cells of users in RollupTable and of the whole organization.
+
+    Cube is never modified. Totals of groups are rolled up on first query
+    and kept by the cube.
+    """
+
+    def __init__(self, users=None, organization=None):
+        self.users = RollupTable() if users is None else users
+        if organization is None:
+            organization = ({}, {}, {})
+            for user_id in self.users.blocks:
+                fold_cells(organization, self.users.get(user_id))
+        self.organization = organization
+        self.groups = {}
+        self.lock = Lock()
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        Builds cube of rows of store.
+        """
+        users = RollupTable()
+        organization = ({}, {}, {})
+        codes = {}
+        for user_id in store.keys():
+            cells = rollup_rows(store[user_id], codes)
+            users.add(user_id, cells)
+            fold_cells(organization, cells)
+        return cls(users, organization)
+
+    def merge(self, other):
+        """
+        Returns cube of rows of both cubes, which must not share any day
+        of the same user.
+        """
+        users = RollupTable()
+        for user_id in sorted(set(self.users.blocks) |
+                              set(other.users.blocks)):
+            if user_id not in other.users:
+                users.copy(self.users, user_id)
+            elif user_id not in self.users:
+                users.copy(other.users, user_id)
+            else:
+                users.add(user_id, merge_cells(
+                    self.users.get(user_id), other.users.get(user_id)))
+        return self.__class__(
+            users, merge_cells(self.organization, other.organization))
+
+    def cells(self, dimension, user_ids=None):
+        """
+        Returns sorted ``(code, Cell)`` pairs of given dimension, of the
+        whole organization or of given group of users.
+
+        Unknown users are left out of groups.
+        """
+        index = DIMENSIONS.index(dimension)
+        if user_ids is None:
+            cells = self.organization
+        else:
+            key = frozenset(user_ids)
+            with self.lock:
+                cells = self.groups.get(key)
+            if cells is None:
+                cells = ({}, {}, {})
+                for user_id in sorted(key):
+                    if user_id in self.users:
+                        fold_cells(cells, self.users.get(user_id))
+                with self.lock:
+                    self.groups[key] = cells
+        return sorted(cells[index].items())
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by cells of users.
+        """
+        return self.users.nbytes
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-fork server for production use.
+
+Master process loads presence data and users XML, opens listening socket
+and forks workers serving requests from it. Workers inherit loaded data
+from the master, so it is parsed once and its pages are shared until
+written. Whenever data files change (or master gets SIGHUP) master loads
+them again, forks new workers and gracefully stops old ones.
+
+Run with:
+
+    python -m presence_analyzer.server [host:port [workers]]
+"""
+
+import logging
+import os
+import signal
+import sys
+import time
+from multiprocessing import cpu_count
+from threading import Thread
+
+from werkzeug.serving import make_server
+
+from presence_analyzer import utils
+from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.main import app
+from presence_analyzer.utils import data_generation
+from presence_analyzer.utils import get_data
+from presence_analyzer.utils import get_directory
+from presence_analyzer.watcher import FileWatcher
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def warm():
+    """
+    Loads presence data and users XML. Returns their generation.
+    """
+    get_data()
+    get_directory()
+    return data_generation()
+
+
+def serve(server):
+    """
+    Serves requests in worker process until SIGTERM.
+
+    Worker never reloads data on its own, its watcher keeps signatures
+    of files as master saw them when data was loaded.
+    """
+    frozen = FileWatcher(float('inf'))
+    frozen.signatures = dict(utils.WATCHER.signatures)
+    utils.WATCHER = frozen
+
+    def stop(*_):
+        """
+        Stops serving once current request is done.
+        """
+        thread = Thread(target=server.shutdown)
+        thread.daemon = True
+        thread.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server.serve_forever()
+
+
+class Master(object):
+
+    """
+    Keeps ``workers`` processes serving requests from ``server`` socket
+    and replaces them when data generation changes. Data files are checked
+    every ``interval`` seconds.
+
+    Retired workers finish requests they are handling and exit; those
+    still running after ``timeout`` seconds are killed.
+    """
+
+    def __init__(self, server, workers, interval=1, timeout=30):
+        self.server = server
+        self.workers = workers
+        self.interval = interval
+        self.timeout = timeout
+        self.children = set()
+        self.retiring = {}
+        self.generation = None
+        self.running = False
+
+    def run(self):
+        """
+        Runs master loop until SIGTERM or SIGINT.
+        """
+        self.running = True
+        # no threads may run at fork, workers could inherit held locks:
+        # polling instead of inotify thread and loading data synchronously
+        utils.WATCHER.stop()
+        utils.WATCHER = FileWatcher(self.interval)
+        get_data.cache.background = False
+        get_directory.cache.background = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, utils.reload_data)
+        self.generation = warm()
+        self.spawn_workers()
+        while self.running:
+            time.sleep(self.interval)
+            self.reap()
+            try:
+                generation = data_generation()
+            except Exception:  # pylint: disable=broad-except
+                # workers keep serving data loaded before, retried next tick
+                log.exception('Reloading data failed')
+                generation = self.generation
+            if generation != self.generation:
+                log.info('Data reloaded, recycling workers')
+                self.generation = generation
+                self.retire()
+            self.spawn_workers()
+            self.kill_stale()
+
+        self.retire()
+        while self.retiring:
+            time.sleep(0.1)
+            self.reap()
+            self.kill_stale()
+        self.server.server_close()
+
+    def stop(self, *_):
+        """
+        Makes master stop workers and exit.
+        """
+        self.running = False
+
+    def spawn_workers(self):
+        """
+        Forks workers until there are enough of them.
+        """
+        while self.running and len(self.children) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    serve(self.server)
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Worker failed')
+                    status = 1
+                finally:
+                    os._exit(status)  # pylint: disable=protected-access
+            log.debug('Started worker %d', pid)
+            self.children.add(pid)
+
+    def retire(self):
+        """
+        Asks all current workers to stop.
+        """
+        deadline = time.time() + self.timeout
+        for pid in self.children:
+            self.kill(pid, signal.SIGTERM)
+            self.retiring[pid] = deadline
+        self.children = set()
+
+    def reap(self):
+        """
+        Forgets exited workers.
+        """
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return
+            if not pid:
+                return
+            if pid in self.children:
+                log.warning('Worker %d died', pid)
+            self.children.discard(pid)
+            self.retiring.pop(pid, None)
+
+    def kill_stale(self):
+        """
+        Kills retired workers which did not stop in time.
+        """
+        now = time.time()
+        for pid, deadline in self.retiring.items():
+            if deadline < now:
+                log.warning('Killing worker %d', pid)
+                self.kill(pid, signal.SIGKILL)
+
+    @staticmethod
+    def kill(pid, signum):
+        """
+        Sends signal to worker which may have already exited.
+        """
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+
+def main(argv):
+    """
+    Starts master serving at address given as ``host:port``.
+    """
+    host, _, port = (argv[1] if len(argv) > 1 else '0.0.0.0:5000') \
+        .rpartition(':')
+    workers = int(argv[2]) if len(argv) > 2 else \
+        app.config['WORKERS'] or cpu_count()
+    server = make_server(host or '0.0.0.0', int(port), app)
+    if app.config['PID_FILE']:
+        with open(app.config['PID_FILE'], 'w') as pidfile:
+            pidfile.write(str(os.getpid()))
+    log.info('Serving on %s:%s with %d workers', host, port, workers)
+    Master(server, workers, app.config['WATCH_INTERVAL']).run()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s [%(name)s] %(message)s')
+    main(sys.argv)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches of presence times.
+
+Sketch is a sparse histogram of values in BIN_SECONDS wide bins. Times of
+day fall into at most 1440 bins however long the history is, quantiles are
+read from cumulative counts with error of at most half a bin, and sketches
+of disjoint sets of rows are merged by adding their counts.
+"""
+
+import math
+from array import array
+from collections import namedtuple
+
+BIN_SECONDS = 60
+# sketches of a user: start, end and presence of each of 7 weekdays
+SKETCHES_PER_USER = 21
+
+
+class QuantileSketch(object):
+
+    """
+    Counts of values in bins, ``bins`` being sorted bin numbers and
+    ``counts`` numbers of values which fell into them.
+    """
+
+    __slots__ = ('bins', 'counts')
+
+    def __init__(self, bins=(), counts=()):
+        self.bins = list(bins)
+        self.counts = list(counts)
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Builds sketch of given values (seconds).
+        """
+        counts = {}
+        for value in values:
+            key = value // BIN_SECONDS
+            counts[key] = counts.get(key, 0) + 1
+        bins = sorted(counts)
+        return cls(bins, [counts[key] for key in bins])
+
+    def __eq__(self, other):
+        return (self.bins, self.counts) == (other.bins, other.counts)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'QuantileSketch({0!r}, {1!r})'.format(self.bins, self.counts)
+
+    @property
+    def count(self):
+        """
+        Number of values in sketch.
+        """
+        return sum(self.counts)
+
+    def merge(self, other):
+        """
+        Returns sketch of values of both sketches.
+        """
+        counts = dict(zip(self.bins, self.counts))
+        for key, count in zip(other.bins, other.counts):
+            counts[key] = counts.get(key, 0) + count
+        bins = sorted(counts)
+        return self.__class__(bins, [counts[key] for key in bins])
+
+    def quantile(self, fraction):
+        """
+        Returns value below which given fraction of values falls, as the
+        middle of the bin holding it. Zero for empty sketch.
+        """
+        total = self.count
+        if not total:
+            return 0
+        rank = min(max(int(math.ceil(fraction * total)), 1), total)
+        seen = 0
+        for key, count in zip(self.bins, self.counts):
+            seen += count
+            if seen >= rank:
+                return key * BIN_SECONDS + BIN_SECONDS // 2
+
+
+class WeekdaySketches(namedtuple('WeekdaySketches', 'start end presence')):
+
+    """
+    Quantile sketches of start, end and presence seconds of one user on
+    one weekday.
+    """
+
+    __slots__ = ()
+
+    def merge(self, other):
+        """
+        Returns sketches of rows of both.
+        """
+        return WeekdaySketches(*[
+            mine.merge(theirs) for mine, theirs in zip(self, other)
+        ])
+
+
+class SketchTable(object):
+
+    """
+    Weekday sketches of many users packed in two flat arrays.
+
+    Bins and counts of SKETCHES_PER_USER sketches of a user lie one after
+    another, ``blocks`` maps user id to their SKETCHES_PER_USER + 1
+    boundaries. Packed sketches take 8 bytes per bin instead of a dict per
+    sketch.
+    """
+
+    def __init__(self, bins=None, counts=None, blocks=None):
+        self.bins = array('i') if bins is None else bins
+        self.counts = array('i') if counts is None else counts
+        self.blocks = {} if blocks is None else blocks
+
+    def __contains__(self, user_id):
+        return user_id in self.blocks
+
+    def add(self, user_id, weekdays):
+        """
+        Appends 7 WeekdaySketches of given user.
+        """
+        blocks = [len(self.bins)]
+        for sketches in weekdays:
+            for sketch in sketches:
+                self.bins.extend(sketch.bins)
+                self.counts.extend(sketch.counts)
+                blocks.append(len(self.bins))
+        self.blocks[user_id] = tuple(blocks)
+
+    def copy(self, other, user_id):
+        """
+        Appends sketches of given user from other table.
+        """
+        blocks = other.blocks[user_id]
+        shift = len(self.bins) - blocks[0]
+        for column, source in ((self.bins, other.bins),
+                               (self.counts, other.counts)):
+            column.fromstring(source[blocks[0]:blocks[-1]].tostring())
+        self.blocks[user_id] = tuple(block + shift for block in blocks)
+
+    def get(self, user_id):
+        """
+        Returns 7 WeekdaySketches of given user.
+        """
+        blocks = self.blocks[user_id]
+        sketches = [
+            QuantileSketch(
+                self.bins[blocks[i]:blocks[i + 1]].tolist(),
+                self.counts[blocks[i]:blocks[i + 1]].tolist())
+            for i in xrange(SKETCHES_PER_USER)
+        ]
+        return tuple(
+            WeekdaySketches(*sketches[i:i + 3])
+            for i in xrange(0, SKETCHES_PER_USER, 3)
+        )
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by packed sketches and their blocks.
+        """
+        block_entry = 24 + 8 * (SKETCHES_PER_USER + 1)  # key and tuple
+        return (
+            (self.bins.itemsize + self.counts.itemsize) * len(self.bins) +
+            block_entry * len(self.blocks)
+        )
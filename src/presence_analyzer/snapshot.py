@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of parsed presence data.
+
+Snapshot file holds a header describing the source CSV file (see
+presence_analyzer.source) and counts of items followed by raw int32
+columns of PresenceStore, users with their row ranges, float64 weekday
+totals, packed quantile sketches and cells of rollup cube. With numpy
+installed columns are memory mapped without copying, so pages are shared
+by all workers reading the snapshot.
+"""
+
+import logging
+import mmap
+import struct
+from array import array
+
+from presence_analyzer.rollup import DIMENSIONS
+from presence_analyzer.rollup import RollupCube
+from presence_analyzer.rollup import RollupTable
+from presence_analyzer.sketch import SKETCHES_PER_USER
+from presence_analyzer.sketch import SketchTable
+from presence_analyzer.source import HEADER
+from presence_analyzer.source import read_header
+from presence_analyzer.source import write as write_derived
+from presence_analyzer.store import PresenceStore
+from presence_analyzer.store import WeekdayTotals
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+MAGIC = 'PRESENCE'
+VERSION = 4
+# number of rows, users, sketch bins, rollup cells of users and of
+# organization
+COUNTS = struct.Struct('=qqqqq')
+# key of organization cells in rollup table
+ORGANIZATION = 0
+
+
+def write(path, store, source):
+    """
+    Writes snapshot of store parsed from given Source.
+    """
+    users = store.keys()
+    firsts = array('i', (store.offsets[user_id][0] for user_id in users))
+    stops = array('i', (store.offsets[user_id][1] for user_id in users))
+    totals = array('d', (
+        value
+        for user_id in users
+        for weekday in store.weekdays[user_id]
+        for value in weekday
+    ))
+    sketches = store.sketches
+    blocks = array('i', (
+        block for user_id in users for block in sketches.blocks[user_id]))
+    cube = store.rollup
+    cube_blocks = array('i', (
+        block for user_id in users for block in cube.users.blocks[user_id]))
+    organization = RollupTable()
+    organization.add(ORGANIZATION, cube.organization)
+
+    counts = COUNTS.pack(
+        store.row_count, len(users), len(sketches.bins), len(cube.users),
+        len(organization))
+    columns = store.columns + (
+        array('i', users), firsts, stops, totals,
+        sketches.bins, sketches.counts, blocks,
+    ) + cube.users.columns + (
+        cube_blocks, array('i', organization.blocks[ORGANIZATION]),
+    ) + organization.columns
+    write_derived(path, MAGIC, VERSION, source, [counts] + [
+        column.tostring() for column in columns])
+
+
+def read(path, source_path, stat, engine=None):
+    """
+    Returns ``(store, source)`` from snapshot of file at ``source_path``
+    with given stat, ``source`` being Source the snapshot was made from.
+
+    Returns None when snapshot is missing or was made from other file.
+    Snapshot of a file that grew since is still valid, only rows appended
+    after ``source.offset`` are missing in the store.
+    """
+    try:
+        snapshot = open(path, 'rb')
+    except IOError:
+        return None
+
+    with snapshot:
+        source = read_header(snapshot, MAGIC, VERSION, source_path, stat)
+        if source is None:
+            return None
+        counts = snapshot.read(COUNTS.size)
+        if len(counts) != COUNTS.size:
+            return None
+        rows, users, bins, cells, organization_cells = COUNTS.unpack(counts)
+
+        if numpy is not None:
+            mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+            reader = MappedReader(mapped, HEADER.size + COUNTS.size)
+        else:
+            reader = FileReader(snapshot)
+        try:
+            columns = [reader.read('i', rows) for _ in xrange(4)]
+            user_ids = reader.read('i', users).tolist()
+            firsts = reader.read('i', users).tolist()
+            stops = reader.read('i', users).tolist()
+            totals = reader.read('d', users * 28).tolist()
+            sketch_bins = reader.read('i', bins)
+            sketch_counts = reader.read('i', bins)
+            blocks = reader.read(
+                'i', users * (SKETCHES_PER_USER + 1)).tolist()
+            cube_columns = tuple(
+                reader.read(typecode, cells)
+                for typecode in RollupTable.typecodes)
+            cube_blocks = reader.read(
+                'i', users * (len(DIMENSIONS) + 1)).tolist()
+            organization_blocks = tuple(
+                reader.read('i', len(DIMENSIONS) + 1).tolist())
+            organization = RollupTable(tuple(
+                reader.read(typecode, organization_cells)
+                for typecode in RollupTable.typecodes
+            ), {ORGANIZATION: organization_blocks})
+        except (EOFError, ValueError):
+            log.warning('Snapshot %s is truncated', path)
+            return None
+
+    weekdays = {}
+    for i, user_id in enumerate(user_ids):
+        weekdays[user_id] = tuple(
+            WeekdayTotals(*[int(value) for value in totals[j:j + 4]])
+            for j in xrange(i * 28, i * 28 + 28, 4)
+        )
+    sketches = SketchTable(sketch_bins, sketch_counts, dict(
+        (user_id, tuple(blocks[i * (SKETCHES_PER_USER + 1):
+                               (i + 1) * (SKETCHES_PER_USER + 1)]))
+        for i, user_id in enumerate(user_ids)
+    ))
+    width = len(DIMENSIONS) + 1
+    cube = RollupCube(RollupTable(cube_columns, dict(
+        (user_id, tuple(cube_blocks[i * width:(i + 1) * width]))
+        for i, user_id in enumerate(user_ids)
+    )), organization.get(ORGANIZATION))
+    store = PresenceStore(
+        *columns, weekdays=weekdays, engine=engine,
+        offsets=dict(zip(user_ids, zip(firsts, stops))), sketches=sketches,
+        rollup=cube
+    )
+    store.mtime = source.mtime
+    return store, source
+
+
+class MappedReader(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Reads numpy arrays backed by memory mapped snapshot.
+    """
+
+    def __init__(self, mapped, position):
+        self.mapped = mapped
+        self.position = position
+
+    def read(self, typecode, length):
+        """
+        Returns next ``length`` items as numpy array sharing snapshot pages.
+        """
+        column = numpy.frombuffer(
+            self.mapped, dtype=numpy.dtype(typecode), count=length,
+            offset=self.position
+        )
+        self.position += column.nbytes
+        return column
+
+
+class FileReader(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Reads arrays copied from snapshot file.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def read(self, typecode, length):
+        """
+        Returns next ``length`` items as array.
+        """
+        column = array(typecode)
+        column.fromfile(self.snapshot, length)
+        return column
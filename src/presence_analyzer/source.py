@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Tracking of presence CSV files parsed incrementally.
+
+Presence exports are append-only, so loaders remember Source of the file
+they parsed: its identity, size and mtime, byte offset of its last parsed
+line and fingerprint of bytes before it. As long as the Source matches the
+file only lines appended after the offset need parsing, otherwise the file
+was replaced, truncated or rewritten in place and is parsed again.
+
+Files derived from the source (snapshots, indexes) start with a header
+holding their magic, format version and Source, so they are used only for
+the file they were made from.
+"""
+
+import os
+import struct
+from collections import namedtuple
+from hashlib import md5
+
+# bytes before parsed offset compared to tell appended file from rewritten
+FINGERPRINT_BYTES = 4096
+# magic, version, source device, inode, size, mtime, parsed bytes and
+# their fingerprint
+HEADER = struct.Struct('=8sIqqqdq16s')
+
+
+def fingerprint(path, offset):
+    """
+    Returns digest of up to FINGERPRINT_BYTES bytes of file just before
+    ``offset``. Digest changes when already parsed end of the file is
+    rewritten in place, while appending to the file keeps it.
+    """
+    start = max(offset - FINGERPRINT_BYTES, 0)
+    with open(path, 'rb') as csvfile:
+        csvfile.seek(start)
+        return md5(csvfile.read(offset - start)).digest()
+
+
+class Source(namedtuple('Source', 'device inode size mtime offset digest')):
+
+    """
+    Stat of a file parsed up to ``offset`` byte and ``digest`` of bytes
+    before the offset, returned by fingerprint.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, path, stat, offset):
+        """
+        Returns Source of file at path with given stat parsed up to offset.
+        """
+        return cls(
+            stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime, offset,
+            fingerprint(path, offset))
+
+    def matches(self, path, stat):
+        """
+        Tells whether file at path with given stat is this file with at
+        most some bytes appended: the same inode, not shorter, modified
+        only together with its size and with parsed bytes unchanged.
+        """
+        if (stat.st_dev, stat.st_ino) != (self.device, self.inode):
+            return False
+        if stat.st_size < max(self.size, self.offset):
+            return False
+        if stat.st_size == self.size and stat.st_mtime != self.mtime:
+            return False
+        return fingerprint(path, self.offset) == self.digest
+
+
+def stat_identity(stat):
+    """
+    Returns device, inode, size and mtime of file with given stat, which
+    tell whether two processes loaded the same version of the file.
+    """
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+
+def write(path, magic, version, source, chunks):
+    """
+    Writes file derived from source: header followed by given strings.
+
+    File is written under temporary name and renamed, so readers never see
+    partial file.
+    """
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as derived:
+        derived.write(HEADER.pack(magic, version, *source))
+        for chunk in chunks:
+            derived.write(chunk)
+    os.rename(tmp_path, path)
+
+
+def read_header(derived, magic, version, path, stat):
+    """
+    Reads header of open derived file. Returns Source it was made from, or
+    None when the file is not of given format version or the source no
+    longer matches file at path with given stat.
+    """
+    header = derived.read(HEADER.size)
+    if len(header) != HEADER.size:
+        return None
+    fields = HEADER.unpack(header)
+    if fields[:2] != (magic, version):
+        return None
+    source = Source(*fields[2:])
+    if not source.matches(path, stat):
+        return None
+    return source
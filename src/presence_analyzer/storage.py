@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of presence data.
+
+Backend is chosen with STORAGE_BACKEND config option. Each backend loads
+an object answering the same queries as PresenceStore: user ids, rows of
+a user and weekday totals of a user within a date range.
+
+Besides loading the whole CSV file into memory, it can be read user by
+user using index of user rows, or imported into SQLite database.
+
+SQLite database is built from CSV file with:
+
+    python -m presence_analyzer.storage import [data.csv [data.sqlite]]
+"""
+
+import datetime
+import os
+import sqlite3
+import sys
+from itertools import izip
+from threading import Lock
+from threading import local
+
+from presence_analyzer.engines import ENGINES
+from presence_analyzer.index import CsvIndex
+from presence_analyzer.loader import CsvLoader
+from presence_analyzer.main import app
+from presence_analyzer.parsing import parse_csv
+from presence_analyzer.source import stat_identity
+from presence_analyzer.store import GENERATIONS
+from presence_analyzer.store import PresenceStore
+from presence_analyzer.store import WeekdayTotals
+from presence_analyzer.store import weekday_sketches
+
+SCHEMA = """
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID
+"""
+
+
+class CsvBackend(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Presence data parsed from CSV file into memory of every process.
+    """
+
+    def __init__(self):
+        self.loader = CsvLoader()
+
+    def load(self, config):
+        """
+        Returns PresenceStore with current content of CSV file.
+        """
+        return self.loader.load(
+            config['DATA_CSV'],
+            ENGINES[config['ANALYTICS_ENGINE']],
+            config['DATA_SNAPSHOT'],
+            config['PARSE_PROCESSES'],
+        )
+
+
+class IndexedCsvBackend(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Presence data read from CSV file user by user, only when queried.
+    """
+
+    def __init__(self):
+        self.index = CsvIndex()
+
+    def load(self, config):
+        """
+        Returns LazyCsvStore of CSV file indexed by user.
+        """
+        return self.index.load(config['DATA_CSV'], config['DATA_INDEX'])
+
+
+class SqliteBackend(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Presence data queried from SQLite database shared by all processes.
+    """
+
+    def load(self, config):  # pylint: disable=no-self-use
+        """
+        Returns SqliteStore of the database.
+        """
+        os.stat(config['DATA_SQLITE'])  # never create missing database
+        return SqliteStore(config['DATA_SQLITE'])
+
+
+class SqliteStore(object):
+
+    """
+    Read only view of presence database.
+
+    Only user ids are read up front, rows and weekday totals of a user are
+    queried using the (user_id, day) primary key. Every thread (and forked
+    process) gets its own connection. Rollup cube is built from all rows
+    on first use.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local()
+        self.generation = next(GENERATIONS)
+        stat = os.stat(path)
+        self.identity = stat_identity(stat)
+        self.mtime = stat.st_mtime
+        self.cube = None
+        self.lock = Lock()
+        self.user_ids = [
+            user_id for user_id, in self.execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id')
+        ]
+        self.user_set = frozenset(self.user_ids)
+
+    def execute(self, query, parameters=()):
+        """
+        Runs query on connection of current thread. Returns cursor.
+        """
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.connection = sqlite3.connect(self.path)
+            self.local.pid = pid
+        return self.local.connection.execute(query, parameters)
+
+    def __contains__(self, user_id):
+        return user_id in self.user_set
+
+    def __iter__(self):
+        return iter(self.user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __getitem__(self, user_id):
+        """
+        Returns list of ``(day, start, end)`` rows of given user.
+        """
+        if user_id not in self.user_set:
+            raise KeyError(user_id)
+        return self.execute(
+            'SELECT day, start_time, end_time FROM presence '
+            'WHERE user_id = ? ORDER BY day', (user_id,)
+        ).fetchall()
+
+    def weekday_totals(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdayTotals of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+        """
+        totals = [WeekdayTotals(0, 0, 0, 0)] * 7
+        rows = self.execute(
+            'SELECT (day - 1) % 7, count(*), sum(end_time - start_time), '
+            'sum(start_time), sum(end_time) FROM presence '
+            'WHERE user_id = ? AND day BETWEEN ? AND ? GROUP BY 1', (
+                user_id,
+                first if first is not None else 1,
+                last if last is not None else datetime.date.max.toordinal(),
+            )
+        )
+        for row in rows:
+            totals[row[0]] = WeekdayTotals(*row[1:])
+        return tuple(totals)
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdaySketches of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+        """
+        return weekday_sketches(self.execute(
+            'SELECT day, start_time, end_time FROM presence '
+            'WHERE user_id = ? AND day BETWEEN ? AND ?', (
+                user_id,
+                first if first is not None else 1,
+                last if last is not None else datetime.date.max.toordinal(),
+            )
+        ))
+
+    def keys(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return list(self.user_ids)
+
+    @property
+    def rollup(self):
+        """
+        RollupCube of all rows.
+        """
+        with self.lock:
+            if self.cube is None:
+                self.cube = PresenceStore.from_rows(self.execute(
+                    'SELECT user_id, day, start_time, end_time '
+                    'FROM presence')).rollup
+        return self.cube
+
+    @property
+    def row_count(self):
+        """
+        Number of presence rows in database.
+        """
+        return self.execute('SELECT count(*) FROM presence').fetchone()[0]
+
+
+def import_csv(csv_path, sqlite_path):
+    """
+    Builds SQLite database from CSV file. Returns number of rows.
+
+    Database is written under temporary name and renamed, so running app
+    switches to the new one at once. When the same user and day occurs
+    more than once the last row wins.
+    """
+    tmp_path = '{0}.{1}.tmp'.format(sqlite_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    with open(csv_path, 'rb') as csvfile:
+        columns = parse_csv(csvfile)
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        # file is not in use before rename, no need for journal
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        with connection:
+            connection.execute(SCHEMA)
+            connection.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                izip(*columns)
+            )
+        connection.execute('ANALYZE')
+        rows = connection.execute('SELECT count(*) FROM presence').fetchone()
+    except sqlite3.Error:
+        os.remove(tmp_path)
+        raise
+    finally:
+        connection.close()
+    os.rename(tmp_path, sqlite_path)
+    return rows[0]
+
+
+BACKENDS = {
+    'csv': CsvBackend(),
+    'csv_index': IndexedCsvBackend(),
+    'sqlite': SqliteBackend(),
+}
+
+
+def main(argv):
+    """
+    Imports CSV file into SQLite database.
+    """
+    if len(argv) < 2 or argv[1] != 'import':
+        sys.exit(
+            'usage: python -m presence_analyzer.storage import '
+            '[data.csv [data.sqlite]]')
+    csv_path = argv[2] if len(argv) > 2 else app.config['DATA_CSV']
+    sqlite_path = argv[3] if len(argv) > 3 else app.config['DATA_SQLITE']
+    rows = import_csv(csv_path, sqlite_path)
+    print 'Imported {0} rows from {1} into {2}'.format(
+        rows, csv_path, sqlite_path)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
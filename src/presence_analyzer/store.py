@@ -0,0 +1,457 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar presence data store.
+"""
+
+import datetime
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import count
+from operator import itemgetter
+from threading import Lock
+
+from presence_analyzer.rollup import RollupCube
+from presence_analyzer.sketch import QuantileSketch
+from presence_analyzer.sketch import SketchTable
+from presence_analyzer.sketch import WeekdaySketches
+
+GENERATIONS = count(1)
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of given date ordinal.
+
+    Ordinal 1 is 0001-01-01 which was a Monday.
+    """
+    return (day - 1) % 7
+
+
+class WeekdayTotals(namedtuple('WeekdayTotals', 'count presence start end')):
+
+    """
+    Presence totals of one user on one weekday: number of days and sums of
+    presence time, start and end seconds.
+    """
+
+    __slots__ = ()
+
+    def merge(self, other):
+        """
+        Returns totals of rows of both, which must not share any day.
+        """
+        return WeekdayTotals(*[mine + theirs for mine, theirs in zip(
+            self, other)])
+
+    def mean(self, field):
+        """
+        Returns arithmetic mean of given field. Zero when there are no days.
+        """
+        return float(getattr(self, field)) / self.count if self.count else 0
+
+
+def weekday_totals(rows):
+    """
+    Sums ``(day, start, end)`` rows by weekday. Returns 7 WeekdayTotals.
+    """
+    totals = [[0, 0, 0, 0] for _ in xrange(7)]
+    for day, start, end in rows:
+        total = totals[weekday(day)]
+        total[0] += 1
+        total[1] += end - start
+        total[2] += start
+        total[3] += end
+    return tuple(WeekdayTotals(*total) for total in totals)
+
+
+def weekday_sketches(rows):
+    """
+    Sketches ``(day, start, end)`` rows by weekday. Returns 7
+    WeekdaySketches.
+    """
+    values = [([], [], []) for _ in xrange(7)]
+    for day, start, end in rows:
+        starts, ends, presences = values[weekday(day)]
+        starts.append(start)
+        ends.append(end)
+        presences.append(end - start)
+    return tuple(
+        WeekdaySketches(*[QuantileSketch.from_values(column)
+                          for column in columns])
+        for columns in values
+    )
+
+
+class DateIndex(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Index answering weekday totals of a date range of one user in
+    O(log n).
+
+    Rows are ordered by weekday and day, so days of one weekday form
+    a sorted block found by bisection. Prefix sums of presence, start and
+    end over all rows give totals of any part of a block by subtraction.
+    """
+
+    def __init__(self, rows):
+        """
+        Takes ``(day, start, end)`` rows of the user.
+        """
+        self.days = array('i')
+        self.sums = tuple(array('d', [0]) for _ in xrange(3))
+        blocks = [0]
+        for day, start, end in sorted(rows, key=self.order):
+            while weekday(day) + 1 >= len(blocks):
+                blocks.append(blocks[-1])
+            blocks[-1] += 1
+            self.days.append(day)
+            for column, value in zip(self.sums, (end - start, start, end)):
+                column.append(column[-1] + value)
+        self.blocks = blocks + [blocks[-1]] * (8 - len(blocks))
+
+    @staticmethod
+    def order(row):
+        """
+        Sort key of ``(day, start, end)`` row: weekday, then day.
+        """
+        return weekday(row[0]), row[0]
+
+    def weekday_totals(self, first, last):
+        """
+        Returns 7 WeekdayTotals of rows from ``first`` to ``last`` day
+        ordinal inclusive.
+        """
+        blocks = self.blocks
+        totals = []
+        for i in xrange(7):
+            lower = bisect_left(self.days, first, blocks[i], blocks[i + 1])
+            upper = bisect_right(self.days, last, lower, blocks[i + 1])
+            totals.append(WeekdayTotals(upper - lower, *[
+                int(column[upper] - column[lower]) for column in self.sums
+            ]))
+        return tuple(totals)
+
+
+class PresenceStore(object):
+
+    """
+    Presence data kept in parallel int32 arrays.
+
+    Row ``i`` says that user ``user_ids[i]`` was present on day ``days[i]``
+    (``datetime.date`` ordinal) from ``starts[i]`` till ``ends[i]``
+    (seconds since midnight). Rows are sorted by user and day, so rows of
+    a single user are contiguous and ``offsets`` maps user id to the
+    ``(first, stop)`` range of user's rows.
+
+    Stores are never modified, every new one gets unique ``generation``
+    which tells derived caches that data changed. ``weekdays`` maps user id
+    to WeekdayTotals precomputed when the store is built, by ``engine``
+    callable if given (see presence_analyzer.engines). Quantile sketches of
+    start, end and presence by user and weekday are built along with them
+    and kept packed in ``sketches`` SketchTable, and so is ``rollup``
+    RollupCube of organization-wide aggregates, unless ``build_rollup`` is
+    False (stores of single users need no cube, their ``rollup`` is None).
+    DateIndex of a user is built on first query of a date range and kept
+    in ``date_indexes``. ``mtime`` is modification time of the source file
+    the rows were loaded from and ``identity`` a value identifying the
+    loaded content of the file in any process (see source.Source), both
+    set by whoever loaded them.
+
+    Columns may be any int32 sequences supporting slicing, ``tolist`` and
+    ``tostring``: arrays or numpy arrays mapped from a snapshot file.
+    """
+
+    typecode = 'i'
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, user_ids, days, starts, ends,
+            weekdays=None, engine=None, offsets=None, sketches=None,
+            rollup=None, build_rollup=True):
+        """
+        Takes four parallel arrays already sorted by user and day and
+        optionally weekday totals, row offsets, sketches and rollup cube of
+        their users.
+        """
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.generation = next(GENERATIONS)
+        self.engine = engine
+        self.date_indexes = {}
+        self.lock = Lock()
+        self.mtime = None
+        self.identity = None
+
+        if offsets is None:
+            self.offsets = {}
+            first = 0
+            for i in xrange(1, len(user_ids) + 1):
+                if i == len(user_ids) or user_ids[i] != user_ids[first]:
+                    self.offsets[user_ids[first]] = (first, i)
+                    first = i
+
+        if weekdays is None and engine is not None:
+            weekdays = engine(self)
+        elif weekdays is None:
+            weekdays = dict(
+                (user_id, weekday_totals(self[user_id]))
+                for user_id in self.offsets
+            )
+        self.weekdays = weekdays
+
+        if sketches is None:
+            sketches = SketchTable()
+            for user_id in sorted(self.offsets):
+                sketches.add(user_id, weekday_sketches(self[user_id]))
+        self.sketches = sketches
+        if rollup is None and build_rollup:
+            rollup = RollupCube.from_store(self)
+        self.rollup = rollup
+
+    @classmethod
+    def from_rows(cls, rows, engine=None, build_rollup=True):
+        """
+        Builds store from iterable of ``(user_id, day, start, end)`` tuples.
+
+        When the same user and day occurs more than once the last row wins.
+        """
+        user_ids = array(cls.typecode)
+        days = array(cls.typecode)
+        starts = array(cls.typecode)
+        ends = array(cls.typecode)
+
+        rows = sorted(rows, key=itemgetter(0, 1))  # stable: last row wins
+        for i, row in enumerate(rows):
+            if i + 1 < len(rows) and rows[i + 1][:2] == row[:2]:
+                continue
+            user_ids.append(row[0])
+            days.append(row[1])
+            starts.append(row[2])
+            ends.append(row[3])
+        return cls(
+            user_ids, days, starts, ends, engine=engine,
+            build_rollup=build_rollup)
+
+    @classmethod
+    def from_columns(  # pylint: disable=too-many-arguments
+            cls, user_ids, days, starts, ends, engine=None,
+            build_rollup=True):
+        """
+        Builds store from four parallel arrays in file order.
+
+        Arrays are used as they are when already sorted by user and day
+        without duplicates, which is the usual layout of presence exports.
+        """
+        for i in xrange(1, len(user_ids)):
+            if (user_ids[i - 1], days[i - 1]) >= (user_ids[i], days[i]):
+                return cls.from_rows(
+                    zip(user_ids, days, starts, ends), engine=engine,
+                    build_rollup=build_rollup)
+        return cls(
+            user_ids, days, starts, ends, engine=engine,
+            build_rollup=build_rollup)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, user_id):
+        """
+        Returns list of ``(day, start, end)`` rows of given user.
+        """
+        first, stop = self.offsets[user_id]
+        return zip(
+            self.days[first:stop].tolist(),
+            self.starts[first:stop].tolist(),
+            self.ends[first:stop].tolist(),
+        )
+
+    def weekday_totals(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdayTotals of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+
+        DateIndex of the user answering date ranges is built on first such
+        call.
+        """
+        if first is None and last is None:
+            return self.weekdays[user_id]
+        with self.lock:
+            index = self.date_indexes.get(user_id)
+        if index is None:
+            index = DateIndex(self[user_id])
+            with self.lock:
+                index = self.date_indexes.setdefault(user_id, index)
+        return index.weekday_totals(
+            first if first is not None else 1,
+            last if last is not None else datetime.date.max.toordinal(),
+        )
+
+    def weekday_sketches(self, user_id, first=None, last=None):
+        """
+        Returns 7 WeekdaySketches of given user, limited to days from
+        ``first`` to ``last`` ordinal inclusive when any of them is given.
+
+        Sketches of date ranges are built from rows of the range.
+        """
+        if first is None and last is None:
+            return self.sketches.get(user_id)
+        lower, upper = self.offsets[user_id]
+        if first is not None:
+            lower = bisect_left(self.days, first, lower, upper)
+        if last is not None:
+            upper = bisect_right(self.days, last, lower, upper)
+        return weekday_sketches(zip(
+            self.days[lower:upper].tolist(),
+            self.starts[lower:upper].tolist(),
+            self.ends[lower:upper].tolist(),
+        ))
+
+    def keys(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.offsets)
+
+    def count(self, user_id):
+        """
+        Returns number of rows of given user.
+        """
+        first, stop = self.offsets[user_id]
+        return stop - first
+
+    @property
+    def row_count(self):
+        """
+        Number of presence rows in store.
+        """
+        return len(self.days)
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by row arrays, offset index, weekday totals,
+        sketches and rollup cube.
+        """
+        index_entry = 3 * 24  # user id key and (first, stop) tuple
+        # user id key, tuple of 7 WeekdayTotals and their 4 ints
+        weekdays_entry = 24 + 112 + 7 * (88 + 4 * 24)
+        return (
+            sum(column.itemsize * len(column) for column in self.columns) +
+            index_entry * len(self.offsets) +
+            weekdays_entry * len(self.weekdays) + self.sketches.nbytes +
+            (self.rollup.nbytes if self.rollup is not None else 0)
+        )
+
+    def merge(self, other):
+        """
+        Returns new store with rows of both stores.
+
+        Rows of ``other`` win over rows of the same user and day. Blocks of
+        users present in only one of stores are copied as array slices and
+        keep their weekday totals, sketches and date indexes. Totals and
+        sketches of users present in both stores are merged unless some
+        days were overwritten, then they are built from merged rows. Rollup
+        cubes are merged unless any day was overwritten, then the cube is
+        built again. Merged store has no cube if ``self`` has none.
+        """
+        columns = tuple(array(self.typecode) for _ in xrange(4))
+        weekdays = {}
+        sketches = SketchTable()
+        with other.lock:
+            date_indexes = dict(other.date_indexes)
+        with self.lock:
+            date_indexes.update(self.date_indexes)
+        overwritten = False
+        for user_id in sorted(set(self.offsets) | set(other.offsets)):
+            if user_id not in other:
+                self._copy_rows(user_id, columns)
+                weekdays[user_id] = self.weekdays[user_id]
+                sketches.copy(self.sketches, user_id)
+            elif user_id not in self:
+                other._copy_rows(user_id, columns)
+                weekdays[user_id] = other.weekdays[user_id]
+                sketches.copy(other.sketches, user_id)
+            else:
+                rows = dict(
+                    (day, (start, end)) for day, start, end in self[user_id])
+                rows.update(
+                    (day, (start, end)) for day, start, end in other[user_id])
+                rows = [(day,) + rows[day] for day in sorted(rows)]
+                date_indexes.pop(user_id, None)
+                for day, start, end in rows:
+                    columns[0].append(user_id)
+                    columns[1].append(day)
+                    columns[2].append(start)
+                    columns[3].append(end)
+                if len(rows) == self.count(user_id) + other.count(user_id):
+                    weekdays[user_id] = tuple(
+                        mine.merge(theirs) for mine, theirs in zip(
+                            self.weekdays[user_id], other.weekdays[user_id])
+                    )
+                    sketches.add(user_id, tuple(
+                        mine.merge(theirs) for mine, theirs in zip(
+                            self.sketches.get(user_id),
+                            other.sketches.get(user_id))
+                    ))
+                else:
+                    overwritten = True
+                    weekdays[user_id] = weekday_totals(rows)
+                    sketches.add(user_id, weekday_sketches(rows))
+        rollup = None
+        if self.rollup is not None and other.rollup is not None and \
+                not overwritten:
+            rollup = self.rollup.merge(other.rollup)
+        store = self.__class__(
+            *columns, weekdays=weekdays, engine=self.engine,
+            sketches=sketches, rollup=rollup,
+            build_rollup=self.rollup is not None)
+        store.date_indexes = date_indexes
+        store.mtime = max(self.mtime, other.mtime)
+        return store
+
+    def _copy_rows(self, user_id, columns):
+        """
+        Appends rows of given user to (user_ids, days, starts, ends) arrays.
+        """
+        first, stop = self.offsets[user_id]
+        for column, source in zip(columns, self.columns):
+            column.fromstring(source[first:stop].tostring())
+
+    @property
+    def columns(self):
+        """
+        Tuple of (user_ids, days, starts, ends) arrays.
+        """
+        return self.user_ids, self.days, self.starts, self.ends
+
+    def to_dict(self):
+        """
+        Returns data in structure returned by former ``get_data``:
+        {user_id: {datetime.date: {'start': time, 'end': time}}}
+        """
+        def to_time(seconds):
+            """
+            Converts seconds since midnight to datetime.time.
+            """
+            minutes, seconds = divmod(seconds, 60)
+            hours, minutes = divmod(minutes, 60)
+            return datetime.time(hours, minutes, seconds)
+
+        data = {}
+        for user_id in self.offsets:
+            data[user_id] = dict(
+                (datetime.date.fromordinal(day),
+                 {'start': to_time(start), 'end': to_time(end)})
+                for day, start, end in self[user_id]
+            )
+        return data
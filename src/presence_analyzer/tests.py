@@ -2,21 +2,77 @@
 """
 Presence analyzer unit tests.
 """
+import BaseHTTPServer
+import calendar
 import datetime
 import json
+import logging
+import os
 import os.path
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zlib
+from itertools import count
 
 from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer import async_server
 from presence_analyzer import main
+from presence_analyzer import utils
+from presence_analyzer import bench
+from presence_analyzer import compression
+from presence_analyzer import fixtures
+from presence_analyzer.compression import COMPRESSION_CACHE
 from presence_analyzer.cron import fetch_xml_file
+from presence_analyzer.engines import numpy
+from presence_analyzer.engines import numpy_engine
+from presence_analyzer.engines import python_engine
+from presence_analyzer import index as index_module
+from presence_analyzer import loader
+from presence_analyzer.index import CsvIndex
+from presence_analyzer.index import LazyCsvStore
+from presence_analyzer.loader import CsvLoader
+from presence_analyzer.metrics import Collected
+from presence_analyzer.metrics import Counter
+from presence_analyzer.metrics import Histogram
+from presence_analyzer.metrics import Registry
+from presence_analyzer.parsing import chunk_ranges
+from presence_analyzer.parsing import parse_csv
+from presence_analyzer.parsing import parse_csv_parallel
+from presence_analyzer.parsing import parse_date
+from presence_analyzer.parsing import parse_time
+from presence_analyzer import snapshot
+from presence_analyzer import store as store_module
+from presence_analyzer import source
+from presence_analyzer.sketch import QuantileSketch
+from presence_analyzer.server import Master
+from presence_analyzer.storage import BACKENDS
+from presence_analyzer.storage import SqliteStore
+from presence_analyzer.storage import import_csv
+from presence_analyzer.store import PresenceStore
+from presence_analyzer.store import weekday_totals
+from presence_analyzer.users import UserDirectory
 from presence_analyzer.utils import cache
+from presence_analyzer.utils import JsonObjectStream
 from presence_analyzer.utils import get_data
+from presence_analyzer.utils import get_directory
 from presence_analyzer.utils import get_users
+from presence_analyzer.utils import group_by_weekday
 from presence_analyzer.utils import group_start_end
 from presence_analyzer.utils import interval
+from presence_analyzer.utils import iter_json
+from presence_analyzer.utils import jsonify
 from presence_analyzer.utils import mean
+from presence_analyzer.utils import memoize
+from presence_analyzer.utils import precomputed
 from presence_analyzer.utils import seconds_since_midnight
+from presence_analyzer.watcher import FileWatcher
+from werkzeug.serving import make_server
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
@@ -39,6 +95,8 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         Before each test, set up a environment.
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'DATA_SNAPSHOT': None})
         self.client = main.app.test_client()
 
     def tearDown(self):
@@ -77,6 +135,11 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         resp = self.client.get(good_url)
         self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            [calendar.day_abbr[weekday], mean(intervals)]
+            for weekday, intervals in enumerate(
+                group_by_weekday(get_data()[11]))
+        ])
 
     def test_presence_weekday_api(self):
         """
@@ -88,6 +151,13 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         resp = self.client.get(good_url)
         self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], ['Weekday', 'Presence (s)'])
+        self.assertEqual(data[1:], [
+            [calendar.day_abbr[weekday], sum(intervals)]
+            for weekday, intervals in enumerate(
+                group_by_weekday(get_data()[11]))
+        ])
 
     def test_presence_start_end_api(self):
         """
@@ -99,6 +169,236 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.status_code, 404)
         resp = self.client.get(good_url)
         self.assertEqual(resp.status_code, 200)
+        starts, ends = group_start_end(get_data()[11])
+        self.assertEqual(json.loads(resp.data), [
+            [calendar.day_abbr[weekday], [start, end]]
+            for weekday, (start, end) in enumerate(zip(starts, ends))
+        ])
+
+    def test_percentile_time_weekday_api(self):
+        """
+        Test median and 90th percentile of presence time by weekday.
+        """
+        resp = self.client.get('/api/v1/median_time_weekday/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[3], ['Thu', 22950])  # 22969 and 22999
+        self.assertEqual(data[5], ['Sat', 0])
+        resp = self.client.get('/api/v1/percentile_time_weekday/11/90')
+        self.assertEqual(json.loads(resp.data)[3], ['Thu', 23010])
+        resp = self.client.get(
+            '/api/v1/median_time_weekday/11?to=2013-09-05')
+        self.assertEqual(json.loads(resp.data)[3], ['Thu', 23010])
+        for url in ('/api/v1/median_time_weekday/9',
+                    '/api/v1/percentile_time_weekday/11/101'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_percentile_start_end_api(self):
+        """
+        Test median and 90th percentile of start and end by weekday.
+        """
+        resp = self.client.get('/api/v1/median_start_end/11')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[3], ['Thu', ['9:28:30', '15:51:30']])
+        self.assertEqual(data[5], ['Sat', [[], []]])
+        resp = self.client.get('/api/v1/percentile_start_end/11/90')
+        self.assertEqual(
+            json.loads(resp.data)[3], ['Thu', ['10:18:30', '16:41:30']])
+        resp = self.client.get('/api/v1/percentile_start_end/11/0')
+        self.assertEqual(
+            json.loads(resp.data)[3], ['Thu', ['9:28:30', '15:51:30']])
+        resp = self.client.get('/api/v1/median_start_end/9')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_organization_api(self):
+        """
+        Test presence of all users aggregated by weekday, week and month.
+        """
+        resp = self.client.get('/api/v1/organization/weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(
+            [cell['period'] for cell in data],
+            ['Mon', 'Tue', 'Wed', 'Thu', 'Fri'])
+        self.assertEqual(data[3], {
+            'period': 'Thu', 'days': 3, 'presence': 69673,
+            'mean_presence': 69673 / 3.0,
+            'first_in': '9:28:08', 'last_out': '17:23:51',
+        })
+        data = json.loads(self.client.get('/api/v1/organization/week').data)
+        self.assertEqual(
+            [(cell['period'], cell['days']) for cell in data],
+            [('2013-W33', 1), ('2013-W36', 1), ('2013-W37', 8)])
+        data = json.loads(self.client.get('/api/v1/organization/month').data)
+        self.assertEqual(
+            [(cell['period'], cell['days']) for cell in data],
+            [('2013-08', 1), ('2013-09', 9)])
+        resp = self.client.get('/api/v1/organization/year')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_group_api(self):
+        """
+        Test presence of group of users aggregated by month.
+        """
+        main.app.config['GROUPS'] = {'team': [10, 37, 99]}
+        try:
+            resp = self.client.get('/api/v1/group/team/month')
+            self.assertEqual(resp.status_code, 200)
+            data = json.loads(resp.data)
+            self.assertEqual(
+                [(cell['period'], cell['days']) for cell in data],
+                [('2013-08', 1), ('2013-09', 3)])
+            self.assertEqual(data[1]['first_in'], '9:19:52')
+            self.assertEqual(data[1]['last_out'], '17:59:52')
+            resp = self.client.get('/api/v1/group/other/month')
+            self.assertEqual(resp.status_code, 404)
+            resp = self.client.get('/api/v1/group/team/year')
+            self.assertEqual(resp.status_code, 404)
+        finally:
+            main.app.config['GROUPS'] = {}
+
+    def test_bulk_api(self):
+        """
+        Test results of many users at once.
+        """
+        resp = self.client.get('/api/v1/bulk?user_id=10,11,9')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['10', '11'])
+        for name in ('mean_time_weekday', 'presence_weekday',
+                     'presence_start_end'):
+            single = self.client.get('/api/v1/{0}/11'.format(name))
+            self.assertEqual(data['11'][name], json.loads(single.data))
+
+        resp = self.client.get('/api/v1/bulk?user_id=all')
+        self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11', '37'])
+        resp = self.client.get('/api/v1/bulk?user_id=10,x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/bulk')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_date_range(self):
+        """
+        Test limiting days with from and to parameters.
+        """
+        url = '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(
+            [presence for _, presence in data[1:]],
+            [0, 16564, 25321, 22969, 0, 0, 0]
+        )
+        url = '/api/v1/presence_start_end/11?to=2013-09-09'
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(data[0], ['Mon', ['9:12:14', '15:54:17']])
+        self.assertEqual(data[1], ['Tue', [[], []]])
+
+        url = '/api/v1/bulk?user_id=10&from=2013-09-11'
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(data['10']['mean_time_weekday'][1], ['Tue', 0])
+        resp = self.client.get('/api/v1/mean_time_weekday/11?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+        for name in ('presence_weekday', 'mean_time_weekday',
+                     'median_time_weekday'):
+            resp = self.client.get(
+                '/api/v1/{0}/10?from=2013-09-12&to=2013-09-01'.format(name))
+            self.assertEqual(resp.status_code, 400)
+        url = '/api/v1/presence_weekday/10?from=2013-09-12&to=2013-09-12'
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_conditional_requests(self):
+        """
+        Test repeated requests are answered with 304 Not Modified.
+        """
+        url = '/api/v1/presence_weekday/11'
+        resp = self.client.get(url)
+        etag = resp.headers['ETag']
+        self.assertEqual(
+            resp.last_modified, datetime.datetime.utcfromtimestamp(
+                int(max(get_data().mtime, get_directory().mtime))))
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, '')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            url + '?from=2013-09-11', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        future = 'Fri, 01 Jan 2100 00:00:00 GMT'
+        resp = self.client.get(url, headers={'If-Modified-Since': future})
+        self.assertEqual(resp.status_code, 304)
+        past = 'Thu, 01 Jan 2004 00:00:00 GMT'
+        resp = self.client.get(url, headers={'If-Modified-Since': past})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_compression(self):
+        """
+        Test responses are compressed when client accepts it.
+        """
+        url = '/api/v1/bulk?user_id=all'
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(
+            zlib.decompress(resp.data, 16 + zlib.MAX_WBITS),
+            self.client.get(url).data
+        )
+
+        url = '/api/v1/users'
+        plain = self.client.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)  # too small
+
+        resp = self.client.get(
+            '/presence_weekday', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('<html', zlib.decompress(resp.data, 31))
+        if compression.brotli is not None:
+            resp = self.client.get(
+                '/presence_weekday', headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            self.assertIn('<html', compression.brotli.decompress(resp.data))
+        resp = self.client.get(
+            '/static/js/jquery.min.js', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+        resp.close()
+
+    def test_compression_cache(self):
+        """
+        Test compressed bodies are reused and ETag becomes weak.
+        """
+        url = '/api/v1/presence_start_end/10'
+        main.app.config.update({'COMPRESS_MIN_SIZE': 10})
+        try:
+            resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+            etag = resp.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            self.assertIn(('gzip', etag[3:-1]), COMPRESSION_CACHE.mem)
+            resp = self.client.get(url, headers={
+                'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+        finally:
+            main.app.config.update({'COMPRESS_MIN_SIZE': 500})
+
+    def test_metrics(self):
+        """
+        Test metrics endpoint exposes request and data metrics.
+        """
+        self.client.get('/api/v1/users')
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'text/plain')
+        self.assertIn(
+            '# TYPE presence_request_duration_seconds histogram', resp.data)
+        self.assertIn(
+            'presence_request_duration_seconds_count'
+            '{endpoint="users_view",status="200"}', resp.data)
+        self.assertIn('presence_data_size{kind="users"} 3', resp.data)
+        self.assertIn(
+            'presence_cache_events_total'
+            '{function="get_data",event="hits"}', resp.data)
 
     def test_presence_weekday_view(self):
         """
@@ -135,6 +435,307 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         )
 
 
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class PresenceAnalyzerViewsNumpyTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run with numpy analytics engine.
+    """
+
+    def setUp(self):
+        """
+        Before each test, switch engine and drop cached data.
+        """
+        super(PresenceAnalyzerViewsNumpyTestCase, self).setUp()
+        main.app.config.update({'ANALYTICS_ENGINE': 'numpy'})
+        get_data.cache.mem.clear()
+
+    def tearDown(self):
+        """
+        Restore default engine.
+        """
+        main.app.config.update({'ANALYTICS_ENGINE': 'python'})
+        get_data.cache.mem.clear()
+
+    def test_engine(self):
+        """
+        Test data is summed by numpy engine.
+        """
+        self.assertIs(get_data().engine, numpy_engine)
+
+
+class PresenceAnalyzerViewsSqliteTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run with SQLite storage backend.
+    """
+
+    def setUp(self):
+        """
+        Before each test, import test data and switch backend.
+        """
+        super(PresenceAnalyzerViewsSqliteTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.tmp_dir, 'presence.sqlite')
+        import_csv(TEST_DATA_CSV, path)
+        main.app.config.update({
+            'STORAGE_BACKEND': 'sqlite', 'DATA_SQLITE': path})
+        get_data.cache.mem.clear()
+
+    def tearDown(self):
+        """
+        Restore default backend.
+        """
+        main.app.config.update({
+            'STORAGE_BACKEND': 'csv',
+            'DATA_SQLITE': main.app.config['MAIN_DATA_SQLITE'],
+        })
+        get_data.cache.mem.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_backend(self):
+        """
+        Test data is queried from database.
+        """
+        self.assertIsInstance(get_data(), SqliteStore)
+
+
+class PresenceAnalyzerViewsIndexTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run with indexed CSV storage backend.
+    """
+
+    def setUp(self):
+        """
+        Before each test, switch backend.
+        """
+        super(PresenceAnalyzerViewsIndexTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        main.app.config.update({
+            'STORAGE_BACKEND': 'csv_index',
+            'DATA_INDEX': os.path.join(self.tmp_dir, 'presence.index'),
+        })
+        BACKENDS['csv_index'].index = CsvIndex()
+        get_data.cache.mem.clear()
+
+    def tearDown(self):
+        """
+        Restore default backend.
+        """
+        main.app.config.update({
+            'STORAGE_BACKEND': 'csv',
+            'DATA_INDEX': main.app.config['MAIN_DATA_INDEX'],
+        })
+        get_data.cache.mem.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_backend(self):
+        """
+        Test data is read by user from indexed file.
+        """
+        self.assertIsInstance(get_data(), LazyCsvStore)
+        self.assertTrue(os.path.exists(main.app.config['DATA_INDEX']))
+
+
+class PresenceAnalyzerStorageTestCase(unittest.TestCase):
+
+    """
+    Storage backends tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, import test data.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'presence.sqlite')
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sqlite_store(self):
+        """
+        Test SQLite store answers queries like PresenceStore.
+        """
+        self.assertEqual(import_csv(TEST_DATA_CSV, self.path), 10)
+        self.assertEqual(os.listdir(self.tmp_dir), ['presence.sqlite'])
+        with open(TEST_DATA_CSV) as csvfile:
+            store = PresenceStore.from_columns(*parse_csv(csvfile))
+        sqlite_store = SqliteStore(self.path)
+        self.assertEqual(sqlite_store.keys(), store.keys())
+        self.assertEqual(list(sqlite_store), store.keys())
+        self.assertEqual(len(sqlite_store), 3)
+        self.assertEqual(sqlite_store.row_count, 10)
+        self.assertIn(10, sqlite_store)
+        self.assertNotIn(12, sqlite_store)
+        self.assertRaises(KeyError, sqlite_store.__getitem__, 12)
+        first = datetime.date(2013, 9, 11).toordinal()
+        for dimension in ('weekday', 'week', 'month'):
+            self.assertEqual(
+                sqlite_store.rollup.cells(dimension),
+                store.rollup.cells(dimension))
+        for user_id in store:
+            self.assertEqual(sqlite_store[user_id], store[user_id])
+            self.assertEqual(
+                sqlite_store.weekday_totals(user_id),
+                store.weekday_totals(user_id))
+            self.assertEqual(
+                sqlite_store.weekday_totals(user_id, first),
+                store.weekday_totals(user_id, first))
+            self.assertEqual(
+                sqlite_store.weekday_sketches(user_id),
+                store.weekday_sketches(user_id))
+            self.assertEqual(
+                sqlite_store.weekday_sketches(user_id, first),
+                store.weekday_sketches(user_id, first))
+        self.assertNotEqual(
+            SqliteStore(self.path).generation, sqlite_store.generation)
+
+    def test_lazy_store(self):
+        """
+        Test store read by user answers queries like PresenceStore.
+        """
+        with open(TEST_DATA_CSV) as csvfile:
+            store = PresenceStore.from_columns(*parse_csv(csvfile))
+        lazy_store = CsvIndex().load(TEST_DATA_CSV)
+        self.assertEqual(lazy_store.keys(), store.keys())
+        self.assertEqual(list(lazy_store), store.keys())
+        self.assertEqual(len(lazy_store), 3)
+        self.assertEqual(lazy_store.ranges[10], ((0, 99, 3),))
+        self.assertEqual(len(lazy_store.ranges[11]), 2)
+        self.assertEqual(lazy_store.row_count, 11)
+        self.assertIn(10, lazy_store)
+        self.assertNotIn(12, lazy_store)
+        self.assertRaises(KeyError, lazy_store.__getitem__, 12)
+        first = datetime.date(2013, 9, 11).toordinal()
+        for dimension in ('weekday', 'week', 'month'):
+            self.assertEqual(
+                lazy_store.rollup.cells(dimension),
+                store.rollup.cells(dimension))
+        for user_id in store:
+            self.assertEqual(lazy_store[user_id], store[user_id])
+            self.assertEqual(
+                lazy_store.weekday_totals(user_id),
+                store.weekday_totals(user_id))
+            self.assertEqual(
+                lazy_store.weekday_totals(user_id, first),
+                store.weekday_totals(user_id, first))
+            self.assertEqual(
+                lazy_store.weekday_sketches(user_id),
+                store.weekday_sketches(user_id))
+            self.assertEqual(
+                lazy_store.weekday_sketches(user_id, first),
+                store.weekday_sketches(user_id, first))
+
+        lazy_store = LazyCsvStore(
+            TEST_DATA_CSV, lazy_store.ranges, cached_users=2)
+        parsed = lazy_store.user_store(10)
+        self.assertIsNone(parsed.rollup)
+        lazy_store.user_store(11)
+        self.assertIs(lazy_store.user_store(10), parsed)
+        lazy_store.user_store(37)
+        self.assertEqual(lazy_store.stores.keys(), [10, 37])
+
+    def test_csv_index(self):
+        """
+        Test index follows appended lines and is restored from file.
+        """
+        csv_path = os.path.join(self.tmp_dir, 'data.csv')
+        index_path = os.path.join(self.tmp_dir, 'data.index')
+        with open(csv_path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '11,2013-09-10,09:28:08,15:51:27\n'
+                '11,2013-09-11,09:1')
+        index = CsvIndex()
+        store = index.load(csv_path, index_path)
+        self.assertEqual(index.offset, 87)
+        self.assertEqual(
+            store.ranges, {10: ((23, 55, 1),), 11: ((55, 87, 1),)})
+        self.assertIs(index.load(csv_path, index_path), store)
+
+        with open(csv_path, 'a') as csvfile:
+            csvfile.write('2:14,15:54:17\n10,2013-09-11,09:19:52,16:07:37\n')
+        appended = index.load(csv_path, index_path)
+        self.assertNotEqual(appended.generation, store.generation)
+        self.assertEqual(appended.ranges, {
+            10: ((23, 55, 1), (119, 151, 1)), 11: ((55, 119, 2),)})
+        self.assertEqual(len(appended[10]), 2)
+        self.assertEqual(len(appended[11]), 2)
+        self.assertEqual(len(store[11]), 1)
+
+        restored = CsvIndex()
+        self.assertEqual(
+            restored.load(csv_path, index_path).ranges, appended.ranges)
+        self.assertEqual(restored.offset, os.path.getsize(csv_path))
+
+        with open(csv_path, 'r+b') as csvfile:
+            csvfile.write('user_id,date,start,end\n12')
+            csvfile.seek(0, os.SEEK_END)
+            csvfile.write('13,2013-09-11,09:19:52,16:07:37\n')
+        rewritten = CsvIndex().load(csv_path, index_path)
+        self.assertEqual(rewritten.keys(), [10, 11, 12, 13])
+        self.assertEqual(
+            index.load(csv_path, index_path).ranges, rewritten.ranges)
+
+        with open(csv_path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertEqual(CsvIndex().load(csv_path, index_path).keys(), [12])
+        self.assertEqual(index.load(csv_path, index_path).keys(), [12])
+
+        stat = os.stat(csv_path)
+        with open(index_path, 'r+b') as index_file:
+            index_file.truncate(source.HEADER.size + 10)
+        self.assertIsNone(index_module.read(index_path, csv_path, stat))
+        self.assertIsNone(
+            index_module.read(csv_path + '.missing', csv_path, stat))
+
+    def test_sqlite_backend(self):
+        """
+        Test missing database is not created.
+        """
+        config = {'DATA_SQLITE': self.path}
+        self.assertRaises(OSError, BACKENDS['sqlite'].load, config)
+        self.assertFalse(os.path.exists(self.path))
+        import_csv(TEST_DATA_CSV, self.path)
+        self.assertEqual(BACKENDS['sqlite'].load(config).row_count, 10)
+
+
+class PresenceAnalyzerEnginesTestCase(unittest.TestCase):
+
+    """
+    Analytics engines tests.
+    """
+
+    def test_python_engine(self):
+        """
+        Test python engine gives the same totals as store itself.
+        """
+        with open(TEST_DATA_CSV) as csvfile:
+            columns = parse_csv(csvfile)
+        store = PresenceStore.from_columns(*columns)
+        summed = PresenceStore.from_columns(*columns, engine=python_engine)
+        self.assertEqual(summed.weekdays, store.weekdays)
+        self.assertEqual(python_engine(store), store.weekdays)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_numpy_engine(self):
+        """
+        Test numpy engine gives results identical to python engine.
+        """
+        with open(main.app.config['MAIN_DATA_CSV']) as csvfile:
+            store = PresenceStore.from_columns(*parse_csv(csvfile))
+        totals = numpy_engine(store)
+        self.assertEqual(totals, python_engine(store))
+        self.assertIsInstance(totals[10][0].presence, int)
+        self.assertEqual(numpy_engine(PresenceStore.from_rows([])), {})
+
+
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
 
     """
@@ -147,6 +748,7 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
         main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'DATA_SNAPSHOT': None})
 
     def tearDown(self):
         """
@@ -154,20 +756,95 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         """
         pass
 
+    def test_etag_identity(self):
+        """
+        Test ETag tells apart data of different files loaded by fresh
+        processes and stays the same for the same file.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        generations = store_module.GENERATIONS
+        loader = BACKENDS['csv'].loader
+        with open(TEST_DATA_CSV) as csvfile:
+            text = csvfile.read()
+
+        def fetch(name, text):
+            """
+            Returns body and ETag of presence of user 10 served from file
+            with given text, loaded like in a new process.
+            """
+            path = os.path.join(tmp_dir, name)
+            if not os.path.exists(path):
+                with open(path, 'w') as csvfile:
+                    csvfile.write(text)
+            store_module.GENERATIONS = count(1)
+            get_data.cache.mem.clear()
+            views.presence_weekday_api.cache.mem.clear()
+            BACKENDS['csv'].loader = CsvLoader()
+            main.app.config.update({'DATA_CSV': path})
+            resp = main.app.test_client().get('/api/v1/presence_weekday/10')
+            return resp.data, resp.headers['ETag']
+
+        try:
+            first = fetch('first.csv', text)
+            second = fetch('second.csv', text.replace(
+                '10,2013-09-10,09:39:05', '10,2013-09-10,08:39:05'))
+            self.assertNotEqual(first[0], second[0])
+            self.assertNotEqual(first[1], second[1])
+            self.assertEqual(fetch('first.csv', text), first)
+        finally:
+            store_module.GENERATIONS = generations
+            BACKENDS['csv'].loader = loader
+            main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+            get_data.cache.mem.clear()
+            shutil.rmtree(tmp_dir)
+
+    def test_get_data_processes(self):
+        """
+        Test get_data parses in process pool only without background
+        reloading threads.
+        """
+        csv_loader = BACKENDS['csv'].loader
+        parse_parallel = loader.parse_csv_parallel
+        min_bytes, loader.PARALLEL_MIN_BYTES = loader.PARALLEL_MIN_BYTES, 0
+        calls = []
+
+        def parse_csv_parallel(*args):
+            """
+            Records parsing in process pool.
+            """
+            calls.append(args)
+            return parse_parallel(*args)
+
+        loader.parse_csv_parallel = parse_csv_parallel
+        main.app.config.update({'PARSE_PROCESSES': 2})
+        try:
+            for background in (True, False):
+                get_data.cache.background = background
+                get_data.cache.mem.clear()
+                BACKENDS['csv'].loader = CsvLoader()
+                self.assertEqual(get_data().keys(), [10, 11, 37])
+                self.assertEqual(len(calls), 0 if background else 1)
+        finally:
+            loader.parse_csv_parallel = parse_parallel
+            loader.PARALLEL_MIN_BYTES = min_bytes
+            main.app.config.update({'PARSE_PROCESSES': 1})
+            get_data.cache.background = True
+            get_data.cache.mem.clear()
+            BACKENDS['csv'].loader = csv_loader
+
     def test_get_data(self):
         """
         Test parsing of CSV file.
         """
         data = get_data()
-        self.assertIsInstance(data, dict)
+        self.assertIsInstance(data, PresenceStore)
         self.assertItemsEqual(data.keys(), [10, 11, 37])
-        sample_date = datetime.date(2013, 9, 10)
-        self.assertIn(sample_date, data[10])
-        self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
-        self.assertEqual(
-            data[10][sample_date]['start'],
-            datetime.time(9, 39, 5)
-        )
+        sample_date = datetime.date(2013, 9, 10).toordinal()
+        self.assertIn((sample_date, 34745, 64792), data[10])
+        self.assertEqual(data.row_count, 10)
+        # malformed line does not override valid one
+        friday = datetime.date(2013, 9, 13).toordinal()
+        self.assertEqual(data[11][-1], (friday, 47816, 54242))
 
     def test_get_users_from_xml(self):
         """
@@ -177,6 +854,10 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertEqual(
             users.get(11),
             {'avatar': '/api/images/users/11', 'name': 'Maciej D.'})
+        self.assertEqual(
+            users.get(37),
+            {'avatar': '/api/images/users/00', 'name': 'User 37'})
+        self.assertIs(get_directory(), get_directory())
 
     def test_mean(self):
         """
@@ -254,6 +935,862 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         self.assertNotEqual(cache_obj.timer_dict, {})
         self.assertEqual(cache_obj.cache_is_valid('count'), True)
 
+    def test_cache_files(self):
+        """
+        Test cache expiring on file change.
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'watched.txt')
+        with open(path, 'w') as watched:
+            watched.write('1')
+        main.app.config['WATCHED_FILE'] = path
+        watcher, utils.WATCHER = utils.WATCHER, FileWatcher(0)
+        try:
+            cached = cache(files=('WATCHED_FILE',))(lambda: open(path).read())
+            self.assertEqual(cached(), '1')
+            with open(path, 'w') as watched:
+                watched.write('22')
+            self.assertEqual(open(path).read(), '22')
+            self.assertEqual(cached(), '22')
+            os.remove(path)
+            self.assertRaises(IOError, cached)
+        finally:
+            utils.WATCHER = watcher
+            shutil.rmtree(tmpdir)
+
+    def test_cache_background(self):
+        """
+        Test stale value is served while background thread refreshes it.
+        """
+        state = {'value': 1}
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            """
+            Returns current value, blocking when asked to.
+            """
+            if state['value'] > 1:
+                started.set()
+                release.wait()
+            return state['value']
+
+        cache_obj = cache(seconds=0, background=True)
+        cached = cache_obj(compute)
+        self.assertEqual(cached(), 1)
+        state['value'] = 2
+        self.assertEqual(cached(), 1)
+        started.wait()
+        self.assertEqual(cached(), 1)
+        release.set()
+        cache_obj.threads.get('compute', threading.Thread()).join()
+        self.assertEqual(cache_obj.mem['compute'], 2)
+        stats = cached.cache.stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertGreaterEqual(stats['refreshes'], 1)
+        self.assertEqual(len(stats['refresh_times']), stats['refreshes'] + 1)
+
+    def test_memoize(self):
+        """
+        Test memoizing results per arguments.
+        """
+        calls = []
+        state = {'generation': 1}
+
+        @memoize(maxsize=2, generation=lambda: state['generation'])
+        def square(number):
+            """
+            Returns square of number recording calls.
+            """
+            calls.append(number)
+            return number * number
+
+        self.assertEqual([square(2), square(3), square(2)], [4, 9, 4])
+        self.assertEqual(calls, [2, 3])
+        square(4)  # evicts least recently used 3
+        square(3)
+        self.assertEqual(calls, [2, 3, 4, 3])
+        self.assertEqual(square.cache.mem.keys(), [(4,), (3,)])
+
+        state['generation'] = 2
+        square(3)
+        self.assertEqual(calls, [2, 3, 4, 3, 3])
+
+        square.cache.seconds = -1
+        square(5)
+        square(5)
+        self.assertEqual(calls[-2:], [5, 5])
+        self.assertEqual(square.cache.hits, 1)
+
+    def test_iter_json(self):
+        """
+        Test streamed JSON is the same as serialized at once.
+        """
+        items = [{'a': 1}, [1.5, 'b'], None]
+        chunks = list(iter_json(iter(items), json.dumps, chunk_size=10))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), json.dumps(items))
+        pairs = [(10, [1, 2]), (11, {'c': u'\u0105'})]
+        chunks = iter_json(JsonObjectStream(pairs), json.dumps)
+        self.assertEqual(json.loads(''.join(chunks)), json.loads(
+            json.dumps(dict(pairs))))
+        self.assertEqual(''.join(iter_json(iter([]), json.dumps)), '[]')
+
+    def test_precomputed(self):
+        """
+        Test response bodies are kept until generation changes.
+        """
+        calls = []
+        state = {'generation': 1}
+
+        @precomputed(lambda: state['generation'])
+        @jsonify
+        def view(user_id):
+            """
+            Returns streamed user id.
+            """
+            calls.append(user_id)
+            return (number for number in (user_id, len(calls)))
+
+        with main.app.test_request_context('/?from=2013-01-01'):
+            self.assertEqual(view(user_id=1).get_data(), '[1, 1]')
+            self.assertEqual(view(user_id=1).get_data(), '[1, 1]')
+            self.assertEqual(view(user_id=2).get_data(), '[2, 2]')
+            state['generation'] = 2
+            resp = view(user_id=1)
+        self.assertEqual(resp.get_data(), '[1, 3]')
+        self.assertEqual(resp.mimetype, 'application/json')
+        with main.app.test_request_context('/'):
+            self.assertEqual(view(user_id=1).get_data(), '[1, 4]')
+
+
+class PresenceAnalyzerWatcherTestCase(unittest.TestCase):
+
+    """
+    File watcher tests.
+    """
+
+    def test_file_watcher(self):
+        """
+        Test signatures are polled at most once per interval.
+        """
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'watched.txt')
+        try:
+            watcher = FileWatcher(3600)
+            self.assertIsNone(watcher.signature(path))
+            open(path, 'w').close()
+            self.assertIsNone(watcher.signature(path))
+            watcher.forget()
+            self.assertIsNotNone(watcher.signature(path))
+            watcher.interval = 0
+            signature = watcher.signature(path)
+            self.assertEqual(signature[1], os.stat(path).st_ino)
+            self.assertEqual(signature[2], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+
+    """
+    Columnar store tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.store = PresenceStore.from_rows([
+            (11, 735121, 100, 200),
+            (10, 735122, 300, 400),
+            (10, 735121, 500, 600),
+            (11, 735121, 700, 800),
+        ])
+
+    def test_from_rows(self):
+        """
+        Test rows are sorted by user and day and last duplicate wins.
+        """
+        self.assertEqual(self.store.keys(), [10, 11])
+        self.assertEqual(self.store.row_count, 3)
+        self.assertEqual(
+            self.store[10], [(735121, 500, 600), (735122, 300, 400)])
+        self.assertEqual(self.store[11], [(735121, 700, 800)])
+        self.assertEqual(self.store.offsets, {10: (0, 2), 11: (2, 3)})
+        self.assertNotIn(12, self.store)
+        self.assertRaises(KeyError, self.store.__getitem__, 12)
+
+    def test_nbytes(self):
+        """
+        Test memory footprint of store.
+        """
+        self.assertEqual(self.store.days.itemsize, 4)
+        self.assertEqual(
+            self.store.nbytes,
+            3 * 4 * 4 + 2 * 72 + 2 * 1424 + 9 * 8 + 2 * 200 + 7 * 24 +
+            2 * 56)
+
+    def test_merge(self):
+        """
+        Test merging rows of two stores.
+        """
+        merged = self.store.merge(PresenceStore.from_rows([
+            (10, 735121, 1, 2),
+            (10, 735123, 3, 4),
+            (12, 735121, 5, 6),
+        ]))
+        self.assertEqual(merged.keys(), [10, 11, 12])
+        self.assertEqual(merged[10], [
+            (735121, 1, 2), (735122, 300, 400), (735123, 3, 4)])
+        self.assertEqual(merged[11], self.store[11])
+        self.assertEqual(merged[12], [(735121, 5, 6)])
+        self.assertEqual(self.store.row_count, 3)
+
+    def test_weekdays(self):
+        """
+        Test weekday totals are kept in sync when stores are merged.
+        """
+        totals = self.store.weekdays[10]
+        self.assertEqual(totals[1], (1, 100, 500, 600))  # 2013-09-10
+        self.assertEqual(totals[2], (1, 100, 300, 400))
+        self.assertEqual(totals[0], (0, 0, 0, 0))
+        self.assertEqual(totals[1].mean('start'), 500.0)
+        self.assertEqual(totals[0].mean('start'), 0)
+
+        rows = [(10, 735121, 1, 2), (10, 735128, 3, 5), (12, 735121, 5, 6)]
+        merged = self.store.merge(PresenceStore.from_rows(rows))
+        self.assertEqual(
+            merged.weekdays,
+            PresenceStore.from_rows(zip(*merged.columns)).weekdays
+        )
+        self.assertEqual(merged.weekdays[10][1], (2, 3, 4, 7))
+        self.assertIs(merged.weekdays[11], self.store.weekdays[11])
+
+        merged = self.store.merge(PresenceStore.from_rows(rows[1:]))
+        self.assertEqual(
+            merged.weekdays,
+            PresenceStore.from_rows(zip(*merged.columns)).weekdays
+        )
+        self.assertEqual(merged.weekdays[10][1], (2, 102, 503, 605))
+        self.assertEqual(self.store.count(10), 2)
+
+    def test_sketches(self):
+        """
+        Test quantiles of sketches and merging them.
+        """
+        sketch = QuantileSketch.from_values([100, 130, 59, 3600, 120])
+        self.assertEqual(sketch.bins, [0, 1, 2, 60])
+        self.assertEqual(sketch.counts, [1, 1, 2, 1])
+        self.assertEqual(sketch.count, 5)
+        self.assertEqual(sketch.quantile(0.5), 150)
+        self.assertEqual(sketch.quantile(0), 30)
+        self.assertEqual(sketch.quantile(1), 3630)
+        self.assertEqual(QuantileSketch().quantile(0.5), 0)
+        self.assertEqual(
+            sketch.merge(QuantileSketch.from_values([61, 7200])),
+            QuantileSketch([0, 1, 2, 60, 120], [1, 2, 2, 1, 1]))
+
+        sketches = self.store.weekday_sketches(10)
+        self.assertEqual(sketches[1].start, QuantileSketch([8], [1]))
+        self.assertEqual(sketches[1].presence, QuantileSketch([1], [1]))
+        self.assertEqual(sketches[0].start.count, 0)
+        self.assertEqual(
+            self.store.weekday_sketches(10, 735122)[1].start.count, 0)
+        self.assertEqual(
+            self.store.weekday_sketches(10, 735122, 735122)[2].start,
+            sketches[2].start)
+
+        rows = [(10, 735128, 3, 5), (11, 735121, 5, 6), (12, 735121, 5, 6)]
+        merged = self.store.merge(PresenceStore.from_rows(rows))
+        rebuilt = PresenceStore.from_rows(zip(*merged.columns))
+        for user_id in (10, 11, 12):
+            self.assertEqual(
+                merged.weekday_sketches(user_id),
+                rebuilt.weekday_sketches(user_id))
+        self.assertEqual(merged.weekday_sketches(10)[1].start.count, 2)
+        self.assertEqual(merged.weekday_sketches(11)[1].start.count, 1)
+
+    def test_rollup(self):
+        """
+        Test rollup cube cells and merging cubes.
+        """
+        cube = self.store.rollup
+        self.assertEqual(cube.cells('weekday'), [
+            (1, (2, 200, 500, 800)), (2, (1, 100, 300, 400))])
+        self.assertEqual(cube.cells('week'), [(201337, (3, 300, 300, 800))])
+        self.assertEqual(cube.cells('month', [10, 12]), [
+            (201309, (2, 200, 300, 600))])
+        self.assertEqual(cube.cells('month', []), [])
+        self.assertEqual(cube.users.get(11), (
+            {1: (1, 100, 700, 800)}, {201337: (1, 100, 700, 800)},
+            {201309: (1, 100, 700, 800)}))
+
+        rows = [(10, 735142, 3, 5), (12, 735121, 5, 6)]
+        merged = self.store.merge(PresenceStore.from_rows(rows))
+        rebuilt = PresenceStore.from_rows(zip(*merged.columns)).rollup
+        self.assertIsNot(merged.rollup.users, rebuilt.users)
+        for dimension in ('weekday', 'week', 'month'):
+            self.assertEqual(
+                merged.rollup.cells(dimension), rebuilt.cells(dimension))
+            self.assertEqual(
+                merged.rollup.cells(dimension, [10, 11]),
+                rebuilt.cells(dimension, [10, 11]))
+        self.assertEqual(merged.rollup.cells('month')[-1][0], 201310)
+
+        merged = self.store.merge(PresenceStore.from_rows([
+            (10, 735121, 1, 2)]))
+        self.assertEqual(merged.rollup.cells('weekday')[0], (
+            1, (2, 101, 1, 800)))
+
+        rows = zip(*self.store.columns)
+        store = PresenceStore.from_rows(rows, build_rollup=False)
+        self.assertIsNone(store.rollup)
+        self.assertEqual(
+            store.nbytes, self.store.nbytes - self.store.rollup.nbytes)
+        self.assertIsNone(store.merge(self.store).rollup)
+        self.assertEqual(store.merge(store)[10], store[10])
+
+    def test_date_index(self):
+        """
+        Test weekday totals of date ranges match totals of filtered rows.
+        """
+        with open(main.app.config['MAIN_DATA_CSV']) as csvfile:
+            store = PresenceStore.from_columns(*parse_csv(csvfile))
+        first = datetime.date(2012, 3, 1).toordinal()
+        last = datetime.date(2012, 12, 31).toordinal()
+        for user_id in store.keys()[:10]:
+            rows = store[user_id]
+            self.assertEqual(
+                store.weekday_totals(user_id, first, last),
+                weekday_totals(row for row in rows if first <= row[0] <= last)
+            )
+            self.assertEqual(
+                store.weekday_totals(user_id, first),
+                weekday_totals(row for row in rows if row[0] >= first)
+            )
+        self.assertIs(store.weekday_totals(10), store.weekdays[10])
+        totals = self.store.weekday_totals(10, 735122, 735122)
+        self.assertEqual(totals[2], (1, 100, 300, 400))
+        self.assertEqual(
+            self.store.weekday_totals(10, 735122, 735121),
+            weekday_totals([]))
+        self.assertEqual(
+            store.weekday_totals(store.keys()[0], last, first),
+            weekday_totals([]))
+
+        user_id = store.keys()[0]
+        self.assertEqual(sorted(store.date_indexes), store.keys()[:10])
+        merged = store.merge(PresenceStore.from_rows([(user_id, last, 1, 2)]))
+        self.assertNotIn(user_id, merged.date_indexes)
+        self.assertIs(
+            merged.date_indexes[store.keys()[1]],
+            store.date_indexes[store.keys()[1]])
+        self.assertEqual(
+            merged.weekday_totals(user_id, first, last),
+            weekday_totals(
+                row for row in merged[user_id] if first <= row[0] <= last))
+
+    def test_to_dict(self):
+        """
+        Test conversion to nested dict structure.
+        """
+        data = self.store.to_dict()
+        self.assertEqual(
+            data[10][datetime.date(2013, 9, 10)],
+            {'start': datetime.time(0, 8, 20), 'end': datetime.time(0, 10)}
+        )
+
+
+class PresenceAnalyzerUsersTestCase(unittest.TestCase):
+
+    """
+    User directory tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.directory = UserDirectory.from_xml(TEST_DATA_XML)
+
+    def test_from_xml(self):
+        """
+        Test users and server are read from XML file.
+        """
+        self.assertEqual(len(self.directory), 10)
+        self.assertIn(10, self.directory)
+        self.assertNotIn('10', self.directory)
+        self.assertEqual(
+            self.directory.get(10),
+            {'avatar': '/api/images/users/10', 'name': 'Maciej Z.'})
+        self.assertEqual(
+            self.directory.get(999),
+            {'avatar': '/api/images/users/00', 'name': 'User 999'})
+        self.assertEqual(self.directory.server, 'https://intranet.stxnext.pl')
+        self.assertEqual(
+            self.directory.avatar_url(11),
+            'https://intranet.stxnext.pl/api/images/users/11')
+        self.assertEqual(self.directory.by_name[0], ('Adrian K.', 176))
+
+    def test_sorted_users(self):
+        """
+        Test listing of users sorted by name, unknown ones included.
+        """
+        self.assertEqual(self.directory.sorted_users([11, 999, 176, 10]), [
+            {'user_id': 176, 'name': 'Adrian K.'},
+            {'user_id': 11, 'name': 'Maciej D.'},
+            {'user_id': 10, 'name': 'Maciej Z.'},
+            {'user_id': 999, 'name': 'User 999'},
+        ])
+        self.assertEqual(UserDirectory({}).sorted_users([]), [])
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+
+    """
+    Metrics tests.
+    """
+
+    def test_histogram(self):
+        """
+        Test histogram keeps cumulative buckets, sum and count.
+        """
+        histogram = Histogram(
+            'test_seconds', 'Test.', labels=('phase',), buckets=(0.1, 1))
+        histogram.observe(0.05, ('a',))
+        histogram.observe(0.5, ('a',))
+        histogram.observe(5, ('a',))
+        with histogram.time(('b"\\',)):
+            pass
+        self.assertEqual(histogram.render().splitlines(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{phase="a",le="0.1"} 1',
+            'test_seconds_bucket{phase="a",le="1"} 2',
+            'test_seconds_bucket{phase="a",le="+Inf"} 3',
+            'test_seconds_sum{phase="a"} 5.55',
+            'test_seconds_count{phase="a"} 3',
+            'test_seconds_bucket{phase="b\\"\\\\",le="0.1"} 1',
+            'test_seconds_bucket{phase="b\\"\\\\",le="1"} 1',
+            'test_seconds_bucket{phase="b\\"\\\\",le="+Inf"} 1',
+            'test_seconds_sum{phase="b\\"\\\\"} ' +
+            repr(histogram.values[('b"\\',)][-1]),
+            'test_seconds_count{phase="b\\"\\\\"} 1',
+        ])
+
+    def test_registry(self):
+        """
+        Test counters and collected metrics are rendered together.
+        """
+        registry = Registry()
+        counter = registry.register(Counter('test_total', 'Test.'))
+        counter.inc()
+        counter.inc(amount=2)
+        registry.register(Collected(
+            'test_size', 'Size.', 'gauge', lambda: [(('x',), 7)],
+            labels=('kind',)))
+        self.assertEqual(registry.render(), (
+            '# HELP test_total Test.\n'
+            '# TYPE test_total counter\n'
+            'test_total 3\n'
+            '# HELP test_size Size.\n'
+            '# TYPE test_size gauge\n'
+            'test_size{kind="x"} 7\n'
+        ))
+
+
+class PresenceAnalyzerBenchTestCase(unittest.TestCase):
+
+    """
+    Synthetic data generator and benchmark suite tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_XML': TEST_DATA_XML,
+            'DATA_SNAPSHOT': main.app.config['MAIN_DATA_SNAPSHOT'],
+        })
+        shutil.rmtree(self.tmp_dir)
+
+    def test_generate(self):
+        """
+        Test generated files are deterministic and in sample formats.
+        """
+        rows = list(fixtures.generate_rows(103, 10, seed=1))
+        self.assertEqual(rows, list(fixtures.generate_rows(103, 10, seed=1)))
+        self.assertNotEqual(rows, list(fixtures.generate_rows(103, 10)))
+        store = PresenceStore.from_columns(*parse_csv(rows))
+        self.assertEqual(store.row_count, 103)
+        self.assertEqual(store.keys(), range(10, 20))
+        self.assertEqual(len(store[10]), 11)
+        self.assertEqual(len(store[19]), 10)
+        for day, start, end in store[10]:
+            self.assertLess(datetime.date.fromordinal(day).weekday(), 5)
+            self.assertLess(start, end)
+
+        path = os.path.join(self.tmp_dir, 'users.xml')
+        fixtures.generate_xml(path, 10)
+        directory = UserDirectory.from_xml(path)
+        self.assertEqual(sorted(directory.users), range(10, 20))
+        self.assertEqual(
+            directory.avatar_url(19),
+            'https://intranet.stxnext.pl/api/images/users/19')
+
+    def test_suite(self):
+        """
+        Test benchmark suite writes results of every scale and endpoint.
+        """
+        output = os.path.join(self.tmp_dir, 'results.json')
+        bench.suite([
+            '--scales', '200,300', '--users', '5', '--requests', '2',
+            '--workdir', self.tmp_dir, '--output', output,
+        ])
+        with open(output) as results_file:
+            results = json.load(results_file)
+        self.assertEqual(
+            [scale['rows'] for scale in results['scales']], [200, 300])
+        scale = results['scales'][0]
+        self.assertEqual(scale['users'], 5)
+        self.assertGreater(scale['cold_load']['parse_s'], 0)
+        self.assertGreaterEqual(
+            scale['cold_load']['max_rss_kb'],
+            scale['cold_load']['max_rss_before_kb'])
+        self.assertItemsEqual(scale['endpoints'], bench.ENDPOINTS)
+        for timings in scale['endpoints'].values():
+            self.assertGreaterEqual(timings['max_rss_growth_kb'], 0)
+
+
+class PresenceAnalyzerParsingTestCase(unittest.TestCase):
+
+    """
+    CSV parser tests.
+    """
+
+    def test_parse_date_time(self):
+        """
+        Test parsing of single fields.
+        """
+        self.assertEqual(
+            parse_date('2013-09-10'), datetime.date(2013, 9, 10).toordinal())
+        self.assertEqual(parse_time('09:39:05'), 34745)
+        self.assertEqual(parse_time('00:00:00'), 0)
+        self.assertRaises(ValueError, parse_date, '2013-02-30')
+        self.assertRaises(ValueError, parse_date, '2013/09/10')
+        self.assertRaises(ValueError, parse_time, '9:39:05')
+        self.assertRaises(ValueError, parse_time, '24:00:00')
+
+    def test_parse_csv(self):
+        """
+        Test parsing of lines, malformed lines are skipped.
+        """
+        user_ids, days, starts, ends = parse_csv([
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            'x,2013-09-10,09:39:05,17:59:52\n',
+            '11,2013-09-13,13:16:56,\n',
+            '99999999999,2013-09-13,13:16:56,15:04:02\n',
+            '11,2013-09-10,09:39:05,17:59:52',
+        ])
+        self.assertEqual(list(user_ids), [10, 11])
+        self.assertEqual(list(days), [735121, 735121])
+        self.assertEqual(list(starts), [34745, 34745])
+        self.assertEqual(list(ends), [64792, 64792])
+
+    def test_parse_csv_file(self):
+        """
+        Test parser gives the same store as row by row construction.
+        """
+        with open(TEST_DATA_CSV) as csvfile:
+            columns = parse_csv(csvfile)
+        self.assertEqual(
+            PresenceStore.from_columns(*columns).to_dict(),
+            PresenceStore.from_rows(zip(*columns)).to_dict()
+        )
+
+    def test_chunk_ranges(self):
+        """
+        Test file is split into ranges of whole lines.
+        """
+        with open(TEST_DATA_CSV, 'rb') as csvfile:
+            content = csvfile.read()
+            size = len(content)
+            for chunks in (1, 2, 3, 5, 100):
+                ranges = chunk_ranges(csvfile, chunks)
+                self.assertLessEqual(len(ranges), chunks)
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], size)
+                for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+                    self.assertEqual(stop, start)
+                    self.assertEqual(content[start - 1], '\n')
+            self.assertEqual(chunk_ranges(csvfile, 3, 40, 40), [(40, 40)])
+
+    def test_parse_csv_parallel(self):
+        """
+        Test parallel parsing gives the same arrays as serial one.
+        """
+        path = main.app.config['MAIN_DATA_CSV']
+        with open(path, 'rb') as csvfile:
+            serial = parse_csv(csvfile)
+            csvfile.seek(1000)
+            csvfile.readline()
+            start = csvfile.tell()
+            tail = parse_csv(csvfile)
+        for processes in (1, 2, 3):
+            self.assertEqual(parse_csv_parallel(path, processes), serial)
+        self.assertEqual(parse_csv_parallel(path, 2, start), tail)
+        self.assertEqual(
+            parse_csv_parallel(TEST_DATA_CSV, 4),
+            parse_csv(open(TEST_DATA_CSV, 'rb')))
+
+
+class PresenceAnalyzerLoaderTestCase(unittest.TestCase):
+
+    """
+    Incremental CSV loader tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to temporary file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        self.loader = CsvLoader()
+
+    def tearDown(self):
+        """
+        Remove temporary files.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, text):
+        """
+        Appends text to data file.
+        """
+        with open(self.path, 'a') as csvfile:
+            csvfile.write(text)
+
+    def test_load_appended(self):
+        """
+        Test only appended lines are parsed.
+        """
+        store = self.loader.load(self.path)
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+        self.assertIs(self.loader.load(self.path), store)
+        mtime = os.path.getmtime(self.path)
+        self.assertEqual(store.mtime, mtime)
+
+        self.append('37,2013-08-13,09:00:00,17:00:00\n37,2013-08-14,09:0')
+        store = self.loader.load(self.path)
+        self.assertEqual(len(store[37]), 2)
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path) - 18)
+
+        self.append('0:00,17:00:00\n')
+        store = self.loader.load(self.path)
+        self.assertEqual(store.mtime, os.path.getmtime(self.path))
+        self.assertEqual(store[37][-1], (735094, 32400, 61200))
+        self.assertEqual(self.loader.offset, os.path.getsize(self.path))
+        self.assertEqual(store.keys(), [10, 11, 37])
+
+    def test_load_parallel(self):
+        """
+        Test file parsed by process pool gives the same store and offset.
+        """
+        min_bytes, loader.PARALLEL_MIN_BYTES = loader.PARALLEL_MIN_BYTES, 0
+        try:
+            parallel = CsvLoader()
+            store = parallel.load(self.path, processes=3)
+            self.assertEqual(
+                store.to_dict(), self.loader.load(self.path).to_dict())
+            self.assertEqual(parallel.offset, self.loader.offset)
+
+            self.append('37,2013-08-13,09:00:00,17:00:00\n37,2013-08-14,09:0')
+            store = parallel.load(self.path, processes=2)
+            self.assertEqual(parallel.offset, os.path.getsize(self.path) - 18)
+            self.assertEqual(len(store[37]), 2)
+        finally:
+            loader.PARALLEL_MIN_BYTES = min_bytes
+
+    def test_load_snapshot(self):
+        """
+        Test fresh loader starts from snapshot and parses appended lines.
+        """
+        snapshot_path = os.path.join(self.tmpdir, 'data.snapshot')
+        store = self.loader.load(self.path, snapshot_path=snapshot_path)
+        self.assertTrue(os.path.exists(snapshot_path))
+
+        self.append('37,2013-08-13,09:00:00,17:00:00\n')
+        loader = CsvLoader()
+        restored = loader.load(self.path, snapshot_path=snapshot_path)
+        self.assertEqual(loader.offset, os.path.getsize(self.path))
+        self.assertEqual(restored.mtime, os.path.getmtime(self.path))
+        self.assertEqual(restored[10], store[10])
+        self.assertEqual(restored.weekdays[10], store.weekdays[10])
+        self.assertEqual(len(restored[37]), 2)
+        rebuilt = PresenceStore.from_rows(zip(*restored.columns))
+        self.assertEqual(restored.weekdays, rebuilt.weekdays)
+
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:39:05,17:59:52\n')
+        loader = CsvLoader()
+        store = loader.load(self.path, snapshot_path=snapshot_path)
+        self.assertEqual(store.keys(), [12])
+
+    def test_snapshot_reader(self):
+        """
+        Test snapshot is read with and without numpy.
+        """
+        snapshot_path = os.path.join(self.tmpdir, 'data.snapshot')
+        store = self.loader.load(self.path, snapshot_path=snapshot_path)
+        stat = os.stat(self.path)
+        mapped, saved = snapshot.read(snapshot_path, self.path, stat)
+        self.assertEqual(saved, self.loader.source)
+        self.assertEqual(saved.offset, self.loader.offset)
+        self.assertEqual(mapped.to_dict(), store.to_dict())
+        self.assertEqual(mapped.offsets, store.offsets)
+
+        numpy_module, snapshot.numpy = snapshot.numpy, None
+        try:
+            copied, _ = snapshot.read(snapshot_path, self.path, stat)
+        finally:
+            snapshot.numpy = numpy_module
+        self.assertEqual(copied.to_dict(), store.to_dict())
+        self.assertEqual(copied.weekdays, store.weekdays)
+        for dimension in ('weekday', 'week', 'month'):
+            for restored in (mapped, copied):
+                self.assertEqual(
+                    restored.rollup.cells(dimension),
+                    store.rollup.cells(dimension))
+                self.assertEqual(
+                    restored.rollup.cells(dimension, [11]),
+                    store.rollup.cells(dimension, [11]))
+        for user_id in store:
+            self.assertEqual(
+                mapped.weekday_sketches(user_id),
+                store.weekday_sketches(user_id))
+            self.assertEqual(
+                copied.weekday_sketches(user_id),
+                store.weekday_sketches(user_id))
+
+        with open(snapshot_path, 'r+b') as snapshot_file:
+            snapshot_file.truncate(snapshot.HEADER.size + 10)
+        self.assertIsNone(snapshot.read(snapshot_path, self.path, stat))
+        self.assertIsNone(
+            snapshot.read(self.path + '.missing', self.path, stat))
+
+    def test_load_replaced(self):
+        """
+        Test truncated or replaced file is parsed again.
+        """
+        self.loader.load(self.path)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-09-10,09:39:05,17:59:52\n')
+        self.assertEqual(self.loader.load(self.path).keys(), [12])
+
+        replacement = os.path.join(self.tmpdir, 'new.csv')
+        shutil.copy(TEST_DATA_CSV, replacement)
+        os.rename(replacement, self.path)
+        self.assertEqual(self.loader.load(self.path).keys(), [10, 11, 37])
+
+    def test_load_rewritten(self):
+        """
+        Test file rewritten in place to a longer one is parsed again, also
+        by fresh loader starting from snapshot.
+        """
+        snapshot_path = os.path.join(self.tmpdir, 'data.snapshot')
+        self.loader.load(self.path, snapshot_path=snapshot_path)
+        with open(self.path) as csvfile:
+            text = csvfile.read()
+        with open(self.path, 'r+b') as csvfile:
+            csvfile.write(text.replace('10,', '12,'))
+            csvfile.write('37,2013-08-13,09:00:00,17:00:00\n')
+        expected = CsvLoader().load(self.path).to_dict()
+        self.assertIn(12, expected)
+        self.assertNotIn(10, expected)
+
+        restored = CsvLoader().load(self.path, snapshot_path=snapshot_path)
+        self.assertEqual(restored.to_dict(), expected)
+        store = self.loader.load(self.path, snapshot_path=snapshot_path)
+        self.assertEqual(store.to_dict(), expected)
+
+    def test_load_rewritten_same_size(self):
+        """
+        Test file modified without changing its size is parsed again, also
+        when the change is far before the parsed offset.
+        """
+        with open(self.path, 'w') as csvfile:
+            for day in xrange(735000, 735400):
+                csvfile.write('10,{0},09:00:00,17:00:00\n'.format(
+                    datetime.date.fromordinal(day)))
+        index = CsvIndex()
+        self.assertEqual(self.loader.load(self.path)[10][0][1], 32400)
+        self.assertEqual(index.load(self.path)[10][0][1], 32400)
+        mtime = os.path.getmtime(self.path)
+
+        with open(self.path, 'r+b') as csvfile:
+            csvfile.seek(14)
+            csvfile.write('08')
+        os.utime(self.path, (mtime + 10, mtime + 10))
+        self.assertEqual(self.loader.load(self.path)[10][0][1], 28800)
+        self.assertEqual(
+            self.loader.load(self.path).mtime, os.path.getmtime(self.path))
+        self.assertEqual(index.load(self.path)[10][0][1], 28800)
+
+        os.utime(self.path, (mtime + 20, mtime + 20))
+        self.assertEqual(
+            self.loader.load(self.path).to_dict(),
+            CsvLoader().load(self.path).to_dict())
+
+
+class StubXmlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    Serves test users XML with ETag, like intranet does.
+    """
+
+    etag = '"users-1"'
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Serves /users.xml, /invalid.xml and 404 for other paths.
+        """
+        if self.path == '/users.xml':
+            if self.headers.getheader('If-None-Match') == self.etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            with open(TEST_DATA_XML) as xml:
+                body = xml.read()
+        elif self.path == '/invalid.xml':
+            body = '<intranet><users><user id="1">'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """
+        Keeps test output clean.
+        """
+        pass
+
 
 class PresenceAnalyzerCronTestCase(unittest.TestCase):
 
@@ -265,21 +1802,301 @@ class PresenceAnalyzerCronTestCase(unittest.TestCase):
         """
         Before each test, set up a environment.
         """
-        self.client = main.app.test_client()
-        self.url = 'http://sargo.bolt.stxnext.pl/users.xml'
+        self.server = BaseHTTPServer.HTTPServer(
+            ('127.0.0.1', 0), StubXmlHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}/'.format(self.server.server_port)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'users.xml')
 
     def tearDown(self):
         """
         Get rid of unused objects after each test.
         """
-        pass
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
 
     def test_cron(self):
         """
         Cron tests
         """
-        self.assertEqual(fetch_xml_file(self.url), 'OK')
-        self.assertFalse(fetch_xml_file(self.url + '11'))
+        url = self.url + 'users.xml'
+        self.assertEqual(fetch_xml_file(url, self.path), 'OK')
+        with open(self.path) as fetched, open(TEST_DATA_XML) as xml:
+            self.assertEqual(fetched.read(), xml.read())
+        self.assertEqual(os.listdir(self.tmp_dir), [
+            'users.xml', 'users.xml.validators'])
+        self.assertEqual(fetch_xml_file(url, self.path), 'NOT MODIFIED')
+        self.assertFalse(fetch_xml_file(self.url + '11', self.path))
+
+        os.remove(self.path)
+        self.assertEqual(fetch_xml_file(url, self.path), 'OK')
+
+    def test_cron_invalid(self):
+        """
+        Test invalid XML does not replace fetched file.
+        """
+        with open(self.path, 'w') as xml:
+            xml.write('old')
+        self.assertFalse(fetch_xml_file(self.url + 'invalid.xml', self.path))
+        with open(self.path) as xml:
+            self.assertEqual(xml.read(), 'old')
+        self.assertEqual(os.listdir(self.tmp_dir), ['users.xml'])
+
+    def test_cron_signal(self):
+        """
+        Test app is signalled to reload after fetching file.
+        """
+        pidfile = os.path.join(self.tmp_dir, 'app.pid')
+        with open(pidfile, 'w') as pid:
+            pid.write(str(os.getpid()))
+        signals = []
+        handler = signal.signal(
+            signal.SIGHUP, lambda *args: signals.append(args[0]))
+        try:
+            fetch_xml_file(self.url + 'users.xml', self.path, pidfile)
+        finally:
+            signal.signal(signal.SIGHUP, handler)
+        self.assertEqual(signals, [signal.SIGHUP])
+
+
+class PresenceAnalyzerServerTestCase(unittest.TestCase):
+
+    """
+    Pre-fork server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({
+            'DATA_CSV': self.path,
+            'DATA_XML': TEST_DATA_XML,
+            'DATA_SNAPSHOT': None,
+        })
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        logging.getLogger('werkzeug').setLevel(logging.NOTSET)
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_SNAPSHOT': main.app.config['MAIN_DATA_SNAPSHOT'],
+        })
+        shutil.rmtree(self.tmp_dir)
+
+    def test_master_threads(self):
+        """
+        Test master forks workers with no other thread running.
+        """
+        server = make_server('127.0.0.1', 0, main.app)
+        master = Master(server, workers=1)
+        watcher = utils.WATCHER
+        handlers = [
+            signal.getsignal(signum)
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+        ]
+        threads = []
+
+        def spawn_workers():
+            """
+            Records threads which would be inherited by workers.
+            """
+            threads.extend(get_data.cache.threads.values())
+            threads.extend(get_directory.cache.threads.values())
+            threads.extend(
+                thread for thread in [getattr(watcher, 'notifier', None)]
+                if thread is not None and thread.is_alive())
+            master.stop()
+
+        master.spawn_workers = spawn_workers
+        try:
+            master.run()
+            self.assertFalse(get_data.cache.background)
+            self.assertFalse(get_directory.cache.background)
+        finally:
+            for signum, handler in zip(
+                    (signal.SIGTERM, signal.SIGINT, signal.SIGHUP), handlers):
+                signal.signal(signum, handler)
+            utils.WATCHER = utils.create_watcher(
+                main.app.config['WATCH_INTERVAL'])
+            get_data.cache.background = True
+            get_directory.cache.background = True
+        self.assertEqual(threads, [])
+
+    def test_master(self):
+        """
+        Test workers serve requests and are replaced when data changes.
+        """
+        server = make_server('127.0.0.1', 0, main.app)
+        url = 'http://127.0.0.1:{0}/api/v1/users'.format(server.server_port)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Master(server, workers=2, interval=0.05, timeout=5).run()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        server.server_close()
+
+        def fetch_users():
+            """
+            Returns number of users listed by a worker.
+            """
+            return len(json.load(urllib2.urlopen(url, timeout=5)))
+
+        try:
+            self.assertEqual(fetch_users(), 3)
+            with open(self.path, 'a') as csvfile:
+                csvfile.write('99,2013-09-10,09:00:00,17:00:00\n')
+            deadline = time.time() + 10
+            while fetch_users() != 4 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(fetch_users(), 4)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+    def test_master_reload_error(self):
+        """
+        Test master survives data failing to load and reloads it later.
+        """
+        server = make_server('127.0.0.1', 0, main.app)
+        url = 'http://127.0.0.1:{0}/api/v1/users'.format(server.server_port)
+        moved_path = self.path + '.moved'
+        pid = os.fork()
+        if pid == 0:
+            try:
+                logging.getLogger('presence_analyzer').disabled = True
+                Master(server, workers=1, interval=0.05, timeout=5).run()
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        server.server_close()
+
+        def fetch_users():
+            """
+            Returns number of users listed by a worker.
+            """
+            return len(json.load(urllib2.urlopen(url, timeout=5)))
+
+        try:
+            self.assertEqual(fetch_users(), 3)
+            os.rename(self.path, moved_path)
+            time.sleep(0.5)
+            self.assertEqual(os.waitpid(pid, os.WNOHANG), (0, 0))
+            with open(moved_path, 'a') as csvfile:
+                csvfile.write('99,2013-09-10,09:00:00,17:00:00\n')
+            os.rename(moved_path, self.path)
+            deadline = time.time() + 10
+            while fetch_users() != 4 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(fetch_users(), 4)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+
+
+@unittest.skipIf(async_server.gevent is None, 'gevent is not installed')
+class PresenceAnalyzerAsyncServerTestCase(unittest.TestCase):
+
+    """
+    Asynchronous server tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, start server in its own thread and event loop.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config.update({'DATA_XML': TEST_DATA_XML})
+        main.app.config.update({'DATA_SNAPSHOT': None})
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.calls = []
+        started = threading.Event()
+
+        def run():
+            """
+            Serves requests until server is stopped.
+            """
+            self.server = async_server.make_server('127.0.0.1', 0)
+            execute = utils.EXECUTOR
+
+            def executor(function, args, kwargs):
+                """
+                Records threads running offloaded calls.
+                """
+                def record(*args, **kwargs):
+                    """
+                    Calls function in executor thread.
+                    """
+                    self.calls.append(threading.current_thread())
+                    return function(*args, **kwargs)
+                return execute(record, args, kwargs)
+
+            utils.EXECUTOR = executor
+            self.stopper = async_server.gevent.get_hub().loop.async_()
+            self.stopper.start(
+                lambda: async_server.gevent.spawn(self.server.stop))
+            self.server.start()
+            started.set()
+            self.server.serve_forever()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait(5)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        """
+        Stop server.
+        """
+        utils.EXECUTOR = None
+        self.stopper.send()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        logging.getLogger('werkzeug').setLevel(logging.NOTSET)
+
+    def test_async_server(self):
+        """
+        Test requests are served while other connections are idle.
+        """
+        idle = []
+        for _ in xrange(50):
+            connection = socket.create_connection(
+                ('127.0.0.1', self.server.server_port))
+            connection.sendall('GET /api/v1/users HTTP/1.1\r\n')
+            idle.append(connection)
+        try:
+            url = self.url + '/api/v1/mean_time_weekday/11?from=2013-09-11'
+            resp = urllib2.urlopen(url, timeout=5)
+            self.assertEqual(resp.getcode(), 200)
+            self.assertEqual(len(json.load(resp)), 7)
+            self.assertEqual(len(self.calls), 1)
+            self.assertIsNot(self.calls[0], self.thread)
+            resp = urllib2.urlopen(url, timeout=5)
+            self.assertEqual(len(self.calls), 1)  # precomputed
+            resp = urllib2.urlopen(
+                self.url + '/api/v1/bulk?user_id=all', timeout=5)
+            self.assertEqual(len(json.load(resp)), 3)
+            self.assertGreater(len(self.calls), 1)
+            self.assertNotIn(self.thread, self.calls)
+            self.assertRaises(
+                urllib2.HTTPError, urllib2.urlopen,
+                self.url + '/api/v1/mean_time_weekday/999', timeout=5)
+        finally:
+            for connection in idle:
+                connection.close()
 
 
 def suite():
@@ -288,8 +2105,23 @@ def suite():
     """
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsNumpyTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsSqliteTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsIndexTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStorageTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerEnginesTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerWatcherTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUsersTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerBenchTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerParsingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLoaderTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerCronTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerServerTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerAsyncServerTestCase))
     return base_suite
 
 
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Directory of users exported from intranet.
+"""
+
+import logging
+import os
+from heapq import merge
+
+from lxml import etree
+
+from presence_analyzer.metrics import LOAD_DURATION
+from presence_analyzer.metrics import LOADED_ROWS
+from presence_analyzer.source import stat_identity
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+DEFAULT_AVATAR = '/api/images/users/00'
+
+
+def default_user(user_id):
+    """
+    Returns data of user missing in users XML.
+    """
+    return {'avatar': DEFAULT_AVATAR, 'name': 'User {0}'.format(user_id)}
+
+
+class UserDirectory(object):
+
+    """
+    Users indexed by id, with their names presorted for listings.
+
+    Directory is immutable, so reloading users XML builds a new one which
+    replaces the old one at once. ``mtime`` is modification time of the
+    XML file it was parsed from, ``identity`` tells its version apart in
+    any process (see source.stat_identity).
+    """
+
+    def __init__(self, users, server=''):
+        """
+        Takes dict of users by id, like
+        {151: {'avatar': '/api/images/users/151', 'name': 'Dawid J.'}}
+        and server URL prefixed to avatars.
+        """
+        self.users = users
+        self.server = server
+        self.mtime = None
+        self.identity = None
+        self.by_name = sorted(
+            (user['name'], user_id) for user_id, user in users.iteritems())
+
+    @classmethod
+    def from_xml(cls, source):
+        """
+        Parses users XML file.
+
+        Elements are dropped as soon as they are read, so the whole tree
+        of a large export is never kept in memory.
+        """
+        stat = os.stat(source)
+        with LOAD_DURATION.time(('users_xml',)):
+            directory = cls._parse(source)
+        directory.mtime = stat.st_mtime
+        directory.identity = stat_identity(stat)
+        LOADED_ROWS.inc(('users_xml',), len(directory))
+        return directory
+
+    @classmethod
+    def _parse(cls, source):
+        """
+        Builds directory from iterparse events.
+        """
+        users = {}
+        server = ''
+        context = etree.iterparse(  # pylint: disable=no-member
+            source, events=('end',), tag=('user', 'server'))
+        for _, element in context:
+            if element.tag == 'server':
+                server = '{0}://{1}'.format(
+                    element.findtext('protocol'), element.findtext('host'))
+            else:
+                try:
+                    user_id = int(element.get('id'))
+                except (TypeError, ValueError):
+                    log.debug('Invalid user id: %s', element.get('id'))
+                else:
+                    users[user_id] = {
+                        'avatar': element.findtext('avatar'),
+                        'name': element.findtext('name'),
+                    }
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+        del context
+        return cls(users, server)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, user_id):
+        """
+        Returns data of given user, default one if user is unknown.
+        """
+        user = self.users.get(user_id)
+        if user is None:
+            return default_user(user_id)
+        return user
+
+    def avatar_url(self, user_id):
+        """
+        Returns absolute URL of user photo.
+        """
+        return self.server + self.get(user_id)['avatar']
+
+    def sorted_users(self, user_ids):
+        """
+        Returns given users as dicts with user id and name sorted by name.
+        """
+        user_ids = set(user_ids)
+        known = (
+            (name, user_id)
+            for name, user_id in self.by_name
+            if user_id in user_ids
+        )
+        unknown = sorted(
+            (default_user(user_id)['name'], user_id)
+            for user_id in user_ids
+            if user_id not in self.users
+        )
+        return [
+            {'user_id': user_id, 'name': name}
+            for name, user_id in merge(known, unknown)
+        ]
@@ -3,21 +3,51 @@
 Helper functions used in views.
 """
 
-import csv
+import calendar
 import logging
+import sys
+from collections import OrderedDict
+from collections import deque
 from datetime import datetime
 from functools import wraps
+from hashlib import md5
 from json import dumps
 from threading import Lock
+from threading import Thread
 from time import time as timer
+from types import GeneratorType
 
 from flask import Response
-from lxml import etree
+from flask import abort
+from flask import copy_current_request_context
+from flask import has_request_context
+from flask import request
 
 from presence_analyzer.main import app
+from presence_analyzer.metrics import CACHE_COMPUTE_DURATION
+from presence_analyzer.metrics import Collected
+from presence_analyzer.metrics import REGISTRY
+from presence_analyzer.parsing import parse_date
+from presence_analyzer.rollup import format_code
+from presence_analyzer.storage import BACKENDS
+from presence_analyzer.store import weekday
+from presence_analyzer.users import UserDirectory
+from presence_analyzer.watcher import create_watcher
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # pylint: disable=invalid-name
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-TREE = etree.parse(app.config['DATA_XML'])  # pylint: disable=no-member
+SERIALIZERS = {'json': dumps}
+if ujson is not None:
+    SERIALIZERS['ujson'] = ujson.dumps
+STREAM_CHUNK_SIZE = 64 * 1024
+WATCHER = create_watcher(app.config['WATCH_INTERVAL'])
+# callable(function, args, kwargs) running function in other thread, set
+# by serving mode which must not block on computations
+EXECUTOR = None
 
 
 class cache(object):  # pylint: disable=invalid-name, too-few-public-methods
@@ -26,15 +56,32 @@ class cache(object):  # pylint: disable=invalid-name, too-few-public-methods
     Decorator class
     """
 
-    def __init__(self, seconds):
+    def __init__(self, seconds=None, files=(), background=False):
         """
         If there are decorator arguments, the function
         to be decorated is not passed to the constructor!
+
+        Cached value expires after given number of seconds (if any) and
+        whenever one of files named by ``files`` config keys changes.
+
+        In ``background`` mode expired value is still returned without
+        locking, while a single thread computes the new one and swaps it in.
         """
         self.seconds = seconds
+        self.files = files
+        self.background = background
         self.mem = {}
         self.timer_dict = {}
+        self.signatures = {}
         self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.threads = {}
+        self.pending = set()
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_times = deque(maxlen=100)
+        self.generation = 0
 
     def __call__(self, func):
         """
@@ -47,131 +94,461 @@ class cache(object):  # pylint: disable=invalid-name, too-few-public-methods
             """
             Checking object in cache. If is not, add object to cache
             """
+            if self.background and func.__name__ in self.mem:
+                if not self.cache_is_valid(func.__name__):
+                    self.refresh(func, args)
+                self.hits += 1
+                return self.mem[func.__name__]
 
             self.lock.acquire()
             try:
-                if func.__name__ in self.mem\
-                        and self.cache_is_valid(func.__name__):
+                is_valid = self.cache_is_valid(func.__name__)
+                if func.__name__ in self.mem and is_valid:
+                    self.hits += 1
                     return self.mem.get(func.__name__)
                 else:
-                    self.mem[func.__name__] = func(*args)
+                    self.misses += 1
+                    self.mem[func.__name__] = self.compute(func, args)
                     return self.mem.get(func.__name__)
             finally:
                 self.lock.release()
+        wrapped_func.cache = self
         return wrapped_func
 
     def cache_is_valid(self, func_name):
         """
         Checking if cache content is not expired
         """
+        signature = tuple(
+            (app.config[key], WATCHER.signature(app.config[key]))
+            for key in self.files
+        )
+        changed = self.signatures.get(func_name, signature) != signature
+        self.signatures[func_name] = signature
+        if self.seconds is None:
+            return not changed
+
         if func_name in self.timer_dict\
-                and not self.timer_dict.get(func_name) < timer():
+                and not self.timer_dict.get(func_name) < timer()\
+                and not changed:
             return True
         else:
             self.timer_dict[func_name] = timer() + self.seconds
             return False
 
+    def compute(self, func, args):
+        """
+        Calls function measuring its duration. Every computed value gets
+        next generation number.
+        """
+        started = timer()
+        value = func(*args)
+        duration = timer() - started
+        self.refresh_times.append(duration)
+        CACHE_COMPUTE_DURATION.observe(duration, (func.__name__,))
+        self.generation += 1
+        return value
+
+    def refresh(self, func, args):
+        """
+        Schedules computing new value in background thread.
+
+        Expiry noticed while refresh is running makes the thread compute
+        the value once again, so changes made meanwhile are not lost.
+        """
+        with self.refresh_lock:
+            self.pending.add(func.__name__)
+            if func.__name__ in self.threads:
+                return
+            thread = Thread(target=self._refresh, args=(func, args))
+            thread.daemon = True
+            self.threads[func.__name__] = thread
+        thread.start()
+
+    def _refresh(self, func, args):
+        """
+        Computes values until no refresh is pending.
+        """
+        while True:
+            with self.refresh_lock:
+                if func.__name__ not in self.pending:
+                    del self.threads[func.__name__]
+                    return
+                self.pending.discard(func.__name__)
+            try:
+                self.mem[func.__name__] = self.compute(func, args)
+                self.refreshes += 1
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Refreshing %s failed', func.__name__)
+
+    def stats(self):
+        """
+        Returns hit, miss and background refresh counters together with
+        durations of recent computations.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_times': list(self.refresh_times),
+        }
+
+
+class memoize(object):  # pylint: disable=invalid-name
+
+    """
+    Decorator caching results per call arguments.
+
+    At most ``maxsize`` least recently used results are kept, each for
+    ``seconds`` (if given) and only as long as ``generation`` callable
+    returns the same value as when the result was computed.
+    """
+
+    def __init__(self, maxsize=128, seconds=None, generation=None):
+        self.maxsize = maxsize
+        self.seconds = seconds
+        self.generation = generation or (lambda: None)
+        self.mem = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, func):
+        """
+        Returns wrapped function.
+        """
+        @wraps(func)
+        def wrapped_func(*args):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            generation = self.generation()
+            with self.lock:
+                entry = self.mem.pop(args, None)
+                if entry is not None and entry[0] == generation\
+                        and (entry[1] is None or entry[1] > timer()):
+                    self.mem[args] = entry
+                    self.hits += 1
+                    return entry[2]
+
+            self.misses += 1
+            result = func(*args)
+            expires = timer() + self.seconds if self.seconds else None
+            with self.lock:
+                self.mem[args] = (generation, expires, result)
+                while len(self.mem) > self.maxsize:
+                    self.mem.popitem(last=False)
+            return result
+        wrapped_func.cache = self
+        return wrapped_func
+
+    def clear(self):
+        """
+        Drops all cached results.
+        """
+        with self.lock:
+            self.mem.clear()
+
+
+class JsonObjectStream(object):  # pylint: disable=too-few-public-methods
+
+    """
+    Iterable of (key, value) pairs to be streamed as JSON object.
+    """
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+def iter_json(result, serialize, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields JSON of generator items or JsonObjectStream pairs in chunks of
+    about ``chunk_size`` bytes, serializing one item at a time.
+    """
+    if isinstance(result, JsonObjectStream):
+        items = (
+            '{0}: {1}'.format(serialize(unicode(key)), serialize(value))
+            for key, value in result.pairs
+        )
+        opening, closing = '{', '}'
+    else:
+        items = (serialize(item) for item in result)
+        opening, closing = '[', ']'
+
+    chunk = [opening]
+    size = 0
+    for i, item in enumerate(items):
+        if i:
+            chunk.append(', ')
+        chunk.append(item)
+        size += len(item)
+        if size >= chunk_size:
+            yield ''.join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(closing)
+    yield ''.join(chunk)
+
 
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Generators and JsonObjectStream results are streamed as JSON array and
+    object without building whole payload in memory, chunks being computed
+    through offload. Serializer is chosen with JSON_SERIALIZER config
+    option.
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
+        serialize = SERIALIZERS[app.config['JSON_SERIALIZER']]
+        result = function(*args, **kwargs)
+        if isinstance(result, (GeneratorType, JsonObjectStream)):
+            return Response(
+                iter_offloaded(iter_json(result, serialize)),
+                mimetype='application/json'
+            )
         return Response(
-            dumps(function(*args, **kwargs)),
+            serialize(result),
             mimetype='application/json'
         )
     return inner
 
 
-@cache(600)
+def conditional(identity, mtime):
+    """
+    Answers conditional requests with 304 Not Modified before running
+    wrapped view.
+
+    ETag is derived from ``identity`` callable, request path and query
+    string, Last-Modified is returned by ``mtime`` callable. Both describe
+    the data the response is computed from, in the same way in every
+    process which loaded the same data.
+    """
+    def decorator(function):
+        """
+        Returns wrapped view.
+        """
+        @wraps(function)
+        def inner(*args, **kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            etag = md5(repr((
+                identity(), request.path, request.query_string
+            ))).hexdigest()
+            last_modified = datetime.utcfromtimestamp(int(mtime() or 0))
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = bool(
+                    request.if_modified_since and
+                    last_modified <= request.if_modified_since
+                )
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = function(*args, **kwargs)
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            return response
+        return inner
+    return decorator
+
+
+def offload(function, *args, **kwargs):
+    """
+    Calls function in EXECUTOR (directly when there is none), with context
+    of current request if any. Exceptions are raised in calling thread.
+    """
+    if EXECUTOR is None:
+        return function(*args, **kwargs)
+
+    def call():
+        """
+        Returns success flag and result or exception info.
+        """
+        try:
+            return True, function(*args, **kwargs)
+        except Exception:  # pylint: disable=broad-except
+            return False, sys.exc_info()
+
+    if has_request_context():
+        call = copy_current_request_context(call)
+    succeeded, result = EXECUTOR(call, (), {})
+    if not succeeded:
+        raise result[0], result[1], result[2]
+    return result
+
+
+def iter_offloaded(iterable):
+    """
+    Yields items of iterable, computing each of them through offload.
+    Streamed responses built by generators thus do not block serving loop.
+    """
+    iterator = iter(iterable)
+    while True:
+        try:
+            item = offload(next, iterator)
+        except StopIteration:
+            return
+        yield item
+
+
+def precomputed(generation, maxsize=1000):
+    """
+    Keeps bodies of responses of wrapped view per view arguments and query
+    string, as long as ``generation`` callable returns the same value.
+    """
+    def decorator(function):
+        """
+        Returns wrapped view.
+        """
+        @memoize(maxsize=maxsize, generation=generation)
+        def render(view_args, query_string):
+            """
+            Returns body, status and mimetype of view response.
+            """
+            response = offload(function, **dict(view_args))
+            return response.get_data(), response.status_code, response.mimetype
+
+        @wraps(function)
+        def inner(**kwargs):
+            """
+            This docstring will be overridden by @wraps decorator.
+            """
+            body, status, mimetype = render(
+                tuple(sorted(kwargs.items())), request.query_string)
+            return Response(body, status=status, mimetype=mimetype)
+        inner.cache = render.cache
+        return inner
+    return decorator
+
+
+@cache(files=('DATA_CSV', 'DATA_SQLITE'), background=True)
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
-
-    It creates structure like this:
-    data = {
-        'user_id': {
-            datetime.date(2013, 10, 1): {
-                'start': datetime.time(9, 0, 0),
-                'end': datetime.time(17, 30, 0),
-            },
-            datetime.date(2013, 10, 2): {
-                'start': datetime.time(8, 30, 0),
-                'end': datetime.time(16, 45, 0),
-            },
-        }
-    }
+    Loads presence data from storage backend chosen in config.
+
+    Returned store (PresenceStore of CSV backend) keeps one row per user
+    and day, each row being user id, date ordinal and start/end seconds
+    since midnight, e.g.
+    data[10] == [(735121, 34745, 64792), (735122, 33592, 58057)]
+
+    After the first call CSV backend parses only lines appended to the
+    file. First call in new process reads snapshot of the file, if there
+    is one.
+
+    PARSE_PROCESSES is honoured only without background reloading (e.g. in
+    pre-fork master), forking parse pool from a process running other
+    threads could leave locks they hold acquired forever in the children.
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    config = app.config
+    if config['PARSE_PROCESSES'] != 1 and get_data.cache.background:
+        log.warning('PARSE_PROCESSES ignored with background reloading')
+        config = dict(config, PARSE_PROCESSES=1)
+    return BACKENDS[config['STORAGE_BACKEND']].load(config)
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def data_generation():
+    """
+    Returns value changing whenever presence data or users XML is reloaded.
+    """
+    get_directory()  # checks users XML for changes
+    return get_data().generation, get_directory.cache.generation
+
 
-    return data
+def data_identity():
+    """
+    Returns value identifying versions of source files of loaded presence
+    data and users XML, the same in every process which loaded them.
+    """
+    return get_data().identity, get_directory().identity
+
+
+def data_mtime():
+    """
+    Returns modification time of source files of loaded presence data and
+    users XML, the later of them.
+    """
+    return max(get_data().mtime, get_directory().mtime)
+
+
+def reload_data(*_):
+    """
+    Makes data files checked for changes on next request. Used as SIGHUP
+    handler, so cron can tell the app about fetched users XML.
+    """
+    WATCHER.forget()
+
+
+@cache(files=('DATA_XML',), background=True)
+def get_directory():
+    """
+    Builds UserDirectory from users XML file.
+
+    Directory is built once per version of the file and swapped in whole.
+    """
+    return UserDirectory.from_xml(app.config['DATA_XML'])
+
+
+def cache_events():
+    """
+    Returns hit, miss and refresh counters of data caches for metrics.
+    """
+    return [
+        ((name, event), function.cache.stats()[event])
+        for name, function in (
+            ('get_data', get_data), ('get_directory', get_directory))
+        for event in ('hits', 'misses', 'refreshes')
+    ]
 
 
-def get_users_from_xml():
+def data_size():
     """
-    Extracts users data from xml file. Returns dict.
-    It creates structure like this:
-    {'151': {'avatar': '/api/images/users/151', 'name': 'Dawid J.'}}
+    Returns numbers of rows and users of loaded data for metrics.
     """
+    data = get_data.cache.mem.get('get_data')
+    if data is None:
+        return []
+    return [(('rows',), data.row_count), (('users',), len(data))]
 
-    users_data = {}
-    for element in TREE.iter('user'):
-        users_data[element.get('id')] = {
-            'avatar': element[0].text, 'name': element[1].text}
-    return users_data
+
+REGISTRY.register(Collected(
+    'presence_cache_events_total',
+    'Hits, misses and background refreshes of data caches.',
+    'counter', cache_events, labels=('function', 'event'),
+))
+REGISTRY.register(Collected(
+    'presence_data_size',
+    'Rows and users of loaded presence data.',
+    'gauge', data_size, labels=('kind',),
+))
 
 
 def get_users():
     """
-    Comparing lists ID's extracted from xml file and csv.
-    If ID from CSV file is not in XML file adding default values.
+    Returns users found in CSV file with their avatar and name from xml
+    file. If ID from CSV file is not in XML file adding default values.
     Structure of dict is below:
 
-    {'151': {'avatar': '/api/images/users/151', 'name': 'Dawid J.'},
+    {151: {'avatar': '/api/images/users/151', 'name': 'Dawid J.'},
     18: {'avatar': '/api/images/users/00', 'name': 'User 18'}}
     """
-
-    out = {}
-    data = get_data()
-    users = get_users_from_xml()
-    for i in data.keys():
-        user = users.get(str(i))
-        if user:
-            out[i] = user
-        else:
-            out[i] = {
-                'avatar': '/api/images/users/00', 'name': 'User {0}'.format(i)}
-    return out
+    directory = get_directory()
+    return dict((i, directory.get(i)) for i in get_data().keys())
 
 
 def get_server():
     """
-    Extracts hostname and protocol data from xml file. Returns string.
+    Returns protocol and hostname from xml file.
     """
-    host = TREE.find('server')[2].text
-    protocol = TREE.find('server')[0].text
-    return '{0}://{1}'.format(host, protocol)
+    return get_directory().server
 
 
 def seconds_to_time(seconds):
@@ -184,15 +561,113 @@ def seconds_to_time(seconds):
     return hms
 
 
+def get_date_range():
+    """
+    Returns first and last day ordinal given as ``from`` and ``to``
+    YYYY-MM-DD query parameters, None for missing ones.
+
+    Aborts with 400 on malformed dates and when ``from`` is after ``to``.
+    """
+    try:
+        first, last = tuple(
+            parse_date(request.args[name]) if name in request.args else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args, exc_info=True)
+        abort(400)
+    if first is not None and last is not None and first > last:
+        log.debug('Reversed date range: %s', request.args)
+        abort(400)
+    return first, last
+
+
+def mean_time_weekday(weekdays):
+    """
+    Returns mean presence time by weekday from 7 WeekdayTotals.
+    """
+    return [
+        (calendar.day_abbr[weekday], totals.mean('presence'))
+        for weekday, totals in enumerate(weekdays)
+    ]
+
+
+def presence_weekday(weekdays):
+    """
+    Returns total presence time by weekday from 7 WeekdayTotals.
+    """
+    result = [
+        (calendar.day_abbr[weekday], totals.presence)
+        for weekday, totals in enumerate(weekdays)
+    ]
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(weekdays):
+    """
+    Returns average start and end by weekday from 7 WeekdayTotals.
+    """
+    return [
+        (calendar.day_abbr[weekday], (
+            seconds_to_time(totals.mean('start')),
+            seconds_to_time(totals.mean('end')),
+        ) if totals.count else ([], []))
+        for weekday, totals in enumerate(weekdays)
+    ]
+
+
+def percentile_time_weekday(sketches, percentile):
+    """
+    Returns given percentile of presence time by weekday from 7
+    WeekdaySketches.
+    """
+    return [
+        (calendar.day_abbr[weekday], day.presence.quantile(percentile / 100.0))
+        for weekday, day in enumerate(sketches)
+    ]
+
+
+def percentile_start_end(sketches, percentile):
+    """
+    Returns given percentile of start and end by weekday from 7
+    WeekdaySketches.
+    """
+    fraction = percentile / 100.0
+    return [
+        (calendar.day_abbr[weekday], (
+            seconds_to_time(day.start.quantile(fraction)),
+            seconds_to_time(day.end.quantile(fraction)),
+        ) if day.start.count else ([], []))
+        for weekday, day in enumerate(sketches)
+    ]
+
+
+def rollup_cells(cells, dimension):
+    """
+    Returns ``(code, Cell)`` pairs of rollup cube as dicts with period
+    label, number of days, total and mean presence, first in and last out.
+    """
+    return [
+        {
+            'period': format_code(dimension, code),
+            'days': cell.count,
+            'presence': cell.presence,
+            'mean_presence': cell.mean(),
+            'first_in': seconds_to_time(cell.first_in),
+            'last_out': seconds_to_time(cell.last_out),
+        }
+        for code, cell in cells
+    ]
+
+
 def group_by_weekday(items):
     """
     Groups presence entries by weekday.
     """
     result = [[], [], [], [], [], [], []]  # one list for every day in week
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result[date.weekday()].append(interval(start, end))
+    for day, start, end in items:
+        result[weekday(day)].append(end - start)
     return result
 
 
@@ -203,11 +678,9 @@ def group_start_end(items):
     result_starts = [[], [], [], [], [], [], []]
     result_ends = [[], [], [], [], [], [], []]
 
-    for date in items:
-        start = items[date]['start']
-        end = items[date]['end']
-        result_starts[date.weekday()].append(seconds_since_midnight(start))
-        result_ends[date.weekday()].append(seconds_since_midnight(end))
+    for day, start, end in items:
+        result_starts[weekday(day)].append(start)
+        result_ends[weekday(day)].append(end)
     result_starts = [
         seconds_to_time(mean(x)) if len(x) > 0 else x for x in result_starts]
     result_ends = [
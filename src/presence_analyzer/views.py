@@ -3,28 +3,79 @@
 Defines views.
 """
 
-import calendar
 import logging
+from time import time as timer
 
+from flask import Response
 from flask import abort
+from flask import g
 from flask import redirect
+from flask import request
 
 from flask_mako import render_template
 
-from operator import itemgetter
-
+from presence_analyzer.compression import compress_response
 from presence_analyzer.main import app
+from presence_analyzer.metrics import REGISTRY
+from presence_analyzer.metrics import REQUEST_DURATION
+from presence_analyzer.rollup import DIMENSIONS
+from presence_analyzer.utils import JsonObjectStream
+from presence_analyzer.utils import conditional
+from presence_analyzer.utils import data_generation
+from presence_analyzer.utils import data_identity
+from presence_analyzer.utils import data_mtime
 from presence_analyzer.utils import get_data
-from presence_analyzer.utils import group_by_weekday
-from presence_analyzer.utils import group_start_end
+from presence_analyzer.utils import get_directory
+from presence_analyzer.utils import get_date_range
 from presence_analyzer.utils import jsonify
-from presence_analyzer.utils import mean
-from presence_analyzer.utils import get_users
-from presence_analyzer.utils import get_server
+from presence_analyzer.utils import mean_time_weekday
+from presence_analyzer.utils import percentile_start_end
+from presence_analyzer.utils import percentile_time_weekday
+from presence_analyzer.utils import presence_start_end
+from presence_analyzer.utils import precomputed
+from presence_analyzer.utils import presence_weekday
+from presence_analyzer.utils import rollup_cells
 
 
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
-HOST = get_server()
+
+
+@app.before_request
+def start_timer():
+    """
+    Remembers when request handling started.
+    """
+    g.started = timer()
+
+
+@app.after_request
+def observe_duration(response):
+    """
+    Records request duration by endpoint and status.
+
+    Streamed responses are timed until streaming starts.
+    """
+    started = getattr(g, 'started', None)
+    if started is not None:
+        REQUEST_DURATION.observe(
+            timer() - started,
+            (request.endpoint or 'none', response.status_code)
+        )
+    return response
+
+
+app.after_request(compress_response)
+
+
+@app.route('/metrics')
+def metrics_view():
+    """
+    Exposes metrics in Prometheus text format.
+    """
+    return Response(
+        REGISTRY.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
 
 
 @app.route('/')
@@ -36,92 +87,202 @@ def mainpage():
 
 
 @app.route('/api/v1/users', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
     """
-    users = get_users()
-
-    id_username_list = [
-        {'user_id': i, 'name': users[i].get('name')}
-        for i in users.keys()]
-    sorted_by_username = sorted(id_username_list, key=itemgetter('name'))
-    return sorted_by_username
+    return get_directory().sorted_users(get_data().keys())
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
 @jsonify
 def mean_time_weekday_api(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+    Days can be limited with ``from`` and ``to`` query parameters.
     """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    return result
+    weekdays = data.weekday_totals(user_id, *get_date_range())
+    return mean_time_weekday(weekdays)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
 @jsonify
 def presence_weekday_api(user_id):
     """
     Returns total presence time of given user grouped by weekday.
+    Days can be limited with ``from`` and ``to`` query parameters.
     """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    weekdays = data.weekday_totals(user_id, *get_date_range())
+    return presence_weekday(weekdays)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
 @jsonify
 def presence_start_end_api(user_id):
     """
     Returns average time start-end of given user grouped by weekday.
+    Days can be limited with ``from`` and ``to`` query parameters.
     """
     data = get_data()
     if user_id not in data:
         log.debug('User %s not found!', user_id)
         abort(404)
-    weekdays = group_start_end(data[user_id])
 
-    result = [
-        (calendar.day_abbr[weekday], start_end)
-        for weekday, start_end in enumerate(zip(weekdays[0], weekdays[1]))
-    ]
-    return result
+    weekdays = data.weekday_totals(user_id, *get_date_range())
+    return presence_start_end(weekdays)
+
+
+@app.route('/api/v1/median_time_weekday/<int:user_id>', methods=['GET'],
+           defaults={'percentile': 50})
+@app.route(
+    '/api/v1/percentile_time_weekday/<int:user_id>/<int:percentile>',
+    methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
+@jsonify
+def percentile_time_weekday_api(user_id, percentile):
+    """
+    Returns median (or other percentile) of presence time of given user
+    grouped by weekday. Days can be limited with ``from`` and ``to`` query
+    parameters.
+    """
+    data = get_data()
+    if user_id not in data or percentile > 100:
+        log.debug('User %s or percentile %s not found!', user_id, percentile)
+        abort(404)
+
+    sketches = data.weekday_sketches(user_id, *get_date_range())
+    return percentile_time_weekday(sketches, percentile)
+
+
+@app.route('/api/v1/median_start_end/<int:user_id>', methods=['GET'],
+           defaults={'percentile': 50})
+@app.route(
+    '/api/v1/percentile_start_end/<int:user_id>/<int:percentile>',
+    methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
+@jsonify
+def percentile_start_end_api(user_id, percentile):
+    """
+    Returns median (or other percentile) of start and end of given user
+    grouped by weekday. Days can be limited with ``from`` and ``to`` query
+    parameters.
+    """
+    data = get_data()
+    if user_id not in data or percentile > 100:
+        log.debug('User %s or percentile %s not found!', user_id, percentile)
+        abort(404)
+
+    sketches = data.weekday_sketches(user_id, *get_date_range())
+    return percentile_start_end(sketches, percentile)
+
+
+@app.route('/api/v1/organization/<dimension>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
+@jsonify
+def organization_api(dimension):
+    """
+    Returns presence of all users aggregated by ``weekday``, ``week`` or
+    ``month``.
+    """
+    if dimension not in DIMENSIONS:
+        log.debug('Dimension %s not found!', dimension)
+        abort(404)
+    return rollup_cells(get_data().rollup.cells(dimension), dimension)
+
+
+@app.route('/api/v1/group/<name>/<dimension>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
+@jsonify
+def group_api(name, dimension):
+    """
+    Returns presence of users of group named in GROUPS config option
+    aggregated by ``weekday``, ``week`` or ``month``.
+    """
+    groups = app.config['GROUPS']
+    if name not in groups or dimension not in DIMENSIONS:
+        log.debug('Group %s or dimension %s not found!', name, dimension)
+        abort(404)
+    return rollup_cells(
+        get_data().rollup.cells(dimension, groups[name]), dimension)
+
+
+@app.route('/api/v1/bulk', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@jsonify
+def bulk_api():
+    """
+    Returns mean_time_weekday, presence_weekday and presence_start_end
+    results of many users at once.
+
+    Users are given as comma separated ``user_id`` query parameter, ``all``
+    selects every user. Unknown users are left out of the result, which is
+    streamed user by user.
+    """
+    data = get_data()
+    date_range = get_date_range()
+    user_ids = request.args.get('user_id', '')
+    if user_ids == 'all':
+        user_ids = data.keys()
+    else:
+        try:
+            user_ids = [int(user_id) for user_id in user_ids.split(',')]
+        except ValueError:
+            log.debug('Invalid user ids: %s', user_ids)
+            abort(400)
+
+    def results():
+        """
+        Yields results of known users.
+        """
+        for user_id in user_ids:
+            if user_id not in data:
+                continue
+            weekdays = data.weekday_totals(user_id, *date_range)
+            yield user_id, {
+                'mean_time_weekday': mean_time_weekday(weekdays),
+                'presence_weekday': presence_weekday(weekdays),
+                'presence_start_end': presence_start_end(weekdays),
+            }
+
+    return JsonObjectStream(results())
 
 
 @app.route('/api/v1/get_url_photo/<int:user_id>', methods=['GET'])
+@conditional(data_identity, data_mtime)
+@precomputed(data_generation)
 @jsonify
 def get_url_photo(user_id):
     """
     Returns url for user photo
     """
 
-    users = get_users()
-    if user_id not in users.keys():
+    if user_id not in get_data():
         log.debug('User %s not found!', user_id)
         abort(404)
-    return {'url': HOST + users[user_id].get('avatar')}
+    return {'url': get_directory().avatar_url(user_id)}
 
 
 @app.route('/presence_weekday')
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Watching data files for changes.
+"""
+
+import logging
+import os
+from time import time as timer
+
+try:
+    import pyinotify
+except ImportError:  # pragma: no cover
+    pyinotify = None  # pylint: disable=invalid-name
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+def stat_signature(path):
+    """
+    Returns (device, inode, size, mtime) of file or None if it is missing.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class FileWatcher(object):
+
+    """
+    Polls stat signatures of files.
+
+    Signature of a file is read again at most once per ``interval``
+    seconds, so checking it on every request costs a dict lookup.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.signatures = {}
+
+    def signature(self, path):
+        """
+        Returns signature of file which changes whenever the file does.
+        """
+        path = os.path.abspath(path)
+        now = timer()
+        checked_at, signature = self.signatures.get(path, (None, None))
+        if checked_at is None or now - checked_at >= self.interval:
+            signature = stat_signature(path)
+            self.signatures[path] = (now, signature)
+        return signature
+
+    def forget(self):
+        """
+        Makes next call of signature read all files again.
+        """
+        self.signatures.clear()
+
+    def stop(self):
+        """
+        Stops threads of the watcher, if any.
+        """
+
+
+class InotifyWatcher(FileWatcher):
+
+    """
+    Watcher re-reading signatures only after inotify reported a change.
+
+    Parent directories are watched, so files replaced by rename (like
+    users XML fetched by cron) are noticed as well.
+    """
+
+    mask = (
+        pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY |
+        pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+    ) if pyinotify else 0
+
+    def __init__(self):
+        FileWatcher.__init__(self, interval=float('inf'))
+        self.directories = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(
+            self.manager, self.process_event)
+        self.notifier.daemon = True
+        self.notifier.start()
+
+    def signature(self, path):
+        """
+        Starts watching parent directory of file on first call.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory not in self.directories:
+            self.manager.add_watch(directory, self.mask)
+            self.directories.add(directory)
+        return FileWatcher.signature(self, path)
+
+    def stop(self):
+        """
+        Stops notifier thread.
+        """
+        self.notifier.stop()
+
+    def process_event(self, event):
+        """
+        Forgets signature of changed file.
+        """
+        self.signatures.pop(event.pathname, None)
+
+
+def create_watcher(interval):
+    """
+    Returns inotify based watcher when pyinotify is available.
+    """
+    if pyinotify is not None:
+        try:
+            return InotifyWatcher()
+        except (OSError, pyinotify.WatchManagerError):
+            log.warning('Cannot use inotify, polling files', exc_info=True)
+    return FileWatcher(interval)
@@ -2,14 +2,21 @@
 """
 Presence analyzer web app.
 """
+import os
 import os.path
 import logging.config
+import signal
 
 from presence_analyzer.main import app
 from presence_analyzer import views  # pylint: disable=unused-import
+from presence_analyzer.utils import reload_data
 
 if __name__ == "__main__":
     INI_FILENAME = os.path.join(os.path.dirname(__file__),
                                 '..', 'runtime', 'debug.ini')
     logging.config.fileConfig(INI_FILENAME, disable_existing_loggers=False)
+    signal.signal(signal.SIGHUP, reload_data)
+    if app.config['PID_FILE']:
+        with open(app.config['PID_FILE'], 'w') as pidfile:
+            pidfile.write(str(os.getpid()))
     app.run(host='0.0.0.0')